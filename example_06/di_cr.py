@@ -1,19 +1,608 @@
+# context.py
+import contextvars
+import threading
+import time
+from typing import List, Optional, Tuple
+
+OK = "ok"
+NOT_FOUND = "not_found"
+DEADLINE_EXCEEDED = "deadline_exceeded"
+ERROR = "error"
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    def __init__(self, timeout: Optional[float] = None):
+        self.expires_at = None if timeout is None else time.monotonic() + timeout
+        self.cancelled = threading.Event()
+
+    def remaining(self) -> Optional[float]:
+        if self.cancelled.is_set():
+            return 0.0
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def remaining_ms(self) -> Optional[int]:
+        remaining = self.remaining()
+        return None if remaining is None else max(1, int(remaining * 1000))
+
+    def expired(self) -> bool:
+        return self.remaining() == 0.0
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def check(self) -> None:
+        if self.cancelled.is_set():
+            raise DeadlineExceeded("Request cancelled")
+        if self.expired():
+            raise DeadlineExceeded("Deadline exceeded")
+
+
+class Trace:
+    __slots__ = ("document_id", "spans", "answered_by")
+
+    def __init__(self, document_id: str):
+        self.document_id = document_id
+        self.spans: List[Tuple[str, float, bool]] = []
+        self.answered_by: Optional[str] = None
+
+    def record(self, tier: str, elapsed: float, found: bool) -> None:
+        self.spans.append((tier, elapsed, found))
+        # Inner tiers finish first, so the first tier that found the document answered it
+        if found and self.answered_by is None:
+            self.answered_by = tier
+
+
+current_trace: contextvars.ContextVar = contextvars.ContextVar("current_trace", default=None)
+
+
+def record_span(tier: str, started: float, found: bool) -> None:
+    trace = current_trace.get()
+    if trace is not None:
+        trace.record(tier, time.perf_counter() - started, found)
+
+
+# resilience.py
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+
+from context import DeadlineExceeded
+
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+class AIMDLimiter:
+    def __init__(
+        self,
+        initial_limit: int = 20,
+        min_limit: int = 1,
+        max_limit: int = 200,
+        latency_target: float = 0.1,
+        backoff: float = 0.5
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        with self.lock:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency: float, failed: bool) -> None:
+        with self.lock:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if failed or latency > self.latency_target:
+                # Calls already in flight at the last decrease report the same overload,
+                # so back off at most once per round trip
+                if now - latency >= self.last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def abandon(self) -> None:
+        # Gives the slot back without feeding the latency into the limit
+        with self.lock:
+            self.in_flight -= 1
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str = "backend",
+        failure_rate: float = 0.5,
+        slow_call_rate: float = 0.5,
+        slow_call_duration: float = 1.0,
+        window_size: int = 50,
+        min_calls: int = 10,
+        reset_timeout: float = 5.0,
+        half_open_calls: int = 3,
+        limiter: Optional[AIMDLimiter] = None
+    ):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_duration = slow_call_duration
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.limiter = limiter
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.half_opened_at = 0.0
+        self.trial_calls = 0
+        self.trial_successes = 0
+        self.outcomes: deque = deque(maxlen=window_size)
+        self.lock = threading.Lock()
+        self.stats: Dict[str, int] = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        self.before_call()
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except DeadlineExceeded:
+            # The caller ran out of budget or cancelled, that says nothing about the backend
+            self.abandon()
+            raise
+        except Exception:
+            self.record(time.perf_counter() - start, failed=True)
+            raise
+        except BaseException:
+            self.abandon()
+            raise
+        self.record(time.perf_counter() - start, failed=False)
+        return result
+
+    def before_call(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            if (
+                self.state == self.HALF_OPEN
+                and self.trial_calls >= self.half_open_calls
+                and now - self.half_opened_at >= self.reset_timeout
+            ):
+                # Trials that never finished must not keep the circuit half open forever
+                self.open()
+            if self.state == self.OPEN:
+                if now - self.opened_at < self.reset_timeout:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(f"Circuit for {self.name} is open")
+                self.state = self.HALF_OPEN
+                self.half_opened_at = now
+                self.trial_calls = 0
+                self.trial_successes = 0
+            if self.state == self.HALF_OPEN and self.trial_calls >= self.half_open_calls:
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(f"Circuit for {self.name} is half open")
+            if self.limiter is not None and not self.limiter.acquire():
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(f"Concurrency limit reached for {self.name}")
+            if self.state == self.HALF_OPEN:
+                self.trial_calls += 1
+            self.stats["calls"] += 1
+
+    def record(self, latency: float, failed: bool) -> None:
+        slow = latency > self.slow_call_duration
+        if self.limiter is not None:
+            self.limiter.release(latency, failed)
+        with self.lock:
+            if failed:
+                self.stats["failures"] += 1
+            if self.state == self.HALF_OPEN:
+                if failed or slow:
+                    self.open()
+                else:
+                    self.trial_successes += 1
+                    if self.trial_successes >= self.half_open_calls:
+                        self.state = self.CLOSED
+                        self.outcomes.clear()
+                return
+            self.outcomes.append((failed, slow))
+            if len(self.outcomes) < self.min_calls:
+                return
+            failures = sum(1 for failed, _ in self.outcomes if failed)
+            slow_calls = sum(1 for _, slow in self.outcomes if slow)
+            if (
+                failures / len(self.outcomes) >= self.failure_rate
+                or slow_calls / len(self.outcomes) >= self.slow_call_rate
+            ):
+                self.open()
+
+    def abandon(self) -> None:
+        if self.limiter is not None:
+            self.limiter.abandon()
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.trial_calls = max(0, self.trial_calls - 1)
+
+    def open(self) -> None:
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
+        self.stats["opened"] += 1
+
+
+# replicas.py
+import statistics
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+
+class Replica:
+    def __init__(self, endpoint: Any, name: str):
+        self.endpoint = endpoint
+        self.name = name
+        self.outstanding = 0
+        self.latency = 0.0
+        self.samples = 0
+        self.failures = 0
+        self.healthy = True
+        self.ejected_until = 0.0
+        self.requests = 0
+
+
+class ReplicaRouter:
+    def __init__(
+        self,
+        replicas: List[Any],
+        primary: Any = None,
+        health_check: Optional[Callable[[Any], None]] = None,
+        decay: float = 0.3,
+        eject_factor: float = 3.0,
+        eject_time: float = 30.0,
+        max_failures: int = 3,
+        min_latency: float = 0.0001,
+        min_samples: int = 10,
+        min_delta: float = 0.005
+    ):
+        # A None primary lets the client fall back to its own connection
+        self.primary = Replica(primary, "primary")
+        self.replicas = [Replica(endpoint, f"replica-{index}") for index, endpoint in enumerate(replicas)]
+        self.health_check = health_check
+        self.decay = decay
+        self.eject_factor = eject_factor
+        self.eject_time = eject_time
+        self.max_failures = max_failures
+        self.min_latency = min_latency
+        # A replica is only ejected after min_samples calls and when it is min_delta seconds
+        # slower than its peers, so a single GC pause or a fast cluster does not trigger it
+        self.min_samples = min_samples
+        self.min_delta = min_delta
+        self.lock = threading.Lock()
+        self.checker: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    def pick(self) -> Replica:
+        now = time.monotonic()
+        with self.lock:
+            candidates = []
+            for replica in self.replicas:
+                if replica.ejected_until and replica.ejected_until <= now:
+                    # Back from ejection, measure it again from scratch
+                    replica.ejected_until = 0.0
+                    replica.latency = 0.0
+                    replica.samples = 0
+                    replica.failures = 0
+                if replica.healthy and not replica.ejected_until:
+                    candidates.append(replica)
+            if not candidates:
+                candidates = [self.primary]
+            replica = min(candidates, key=lambda r: (r.outstanding + 1) * max(r.latency, self.min_latency))
+            replica.outstanding += 1
+            replica.requests += 1
+            return replica
+
+    def call(self, func: Callable, *args) -> Any:
+        replica = self.pick()
+        start = time.perf_counter()
+        try:
+            result = func(replica.endpoint, *args)
+        except Exception:
+            self.record(replica, time.perf_counter() - start, failed=True)
+            raise
+        self.record(replica, time.perf_counter() - start, failed=False)
+        return result
+
+    def record(self, replica: Replica, latency: float, failed: bool) -> None:
+        with self.lock:
+            replica.outstanding -= 1
+            replica.samples += 1
+            if replica.latency == 0.0:
+                replica.latency = latency
+            else:
+                replica.latency = (1 - self.decay) * replica.latency + self.decay * latency
+            if replica is self.primary:
+                return
+            if failed:
+                replica.failures += 1
+                if replica.failures >= self.max_failures:
+                    replica.ejected_until = time.monotonic() + self.eject_time
+            else:
+                replica.failures = 0
+            self.eject_slow()
+
+    def eject_slow(self) -> None:
+        # Must be called with self.lock held
+        for replica in sorted(self.replicas, key=lambda r: r.latency, reverse=True):
+            active = [
+                r for r in self.replicas
+                if r.healthy and not r.ejected_until and r.latency > 0 and r.samples >= self.min_samples
+            ]
+            if len(active) < 2 or replica not in active:
+                continue
+            # Compare against the other replicas only, otherwise an outlier drags the median with it
+            median = statistics.median(r.latency for r in active if r is not replica)
+            if replica.latency > max(self.eject_factor * median, median + self.min_delta):
+                replica.ejected_until = time.monotonic() + self.eject_time
+
+    def check_health(self) -> None:
+        if self.health_check is None:
+            return
+        for replica in self.replicas:
+            try:
+                self.health_check(replica.endpoint)
+                healthy = True
+            except Exception:
+                healthy = False
+            with self.lock:
+                replica.healthy = healthy
+
+    def start_health_checks(self, interval: float = 5.0) -> None:
+        def run():
+            while not self.stopped.wait(interval):
+                self.check_health()
+
+        self.checker = threading.Thread(target=run, daemon=True)
+        self.checker.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def stats(self) -> List[dict]:
+        with self.lock:
+            return [
+                {
+                    "name": replica.name,
+                    "requests": replica.requests,
+                    "outstanding": replica.outstanding,
+                    "latency": replica.latency,
+                    "healthy": replica.healthy,
+                    "ejected": bool(replica.ejected_until)
+                }
+                for replica in [self.primary] + self.replicas
+            ]
+
+
+# snapshots.py
+import hashlib
+import json
+import mmap
+import os
+import struct
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+SNAPSHOT_MAGIC = b"CRSNAP01"
+INDEX_MAGIC = b"CRINDX01"
+SNAPSHOT_VERSION = 3
+# magic, format version, source config fingerprint, entry count
+HEADER = struct.Struct("<8sH20sI")
+# snapshot size and the SHA-1 the snapshot ends with, ties an index to one snapshot file
+INDEX_BINDING = struct.Struct("<Q20s")
+# key length, codec, wall-clock expiry in epoch seconds (-1 without ttl), value length, raw value length
+RECORD = struct.Struct("<IBdII")
+# key hash, record offset
+INDEX_ENTRY = struct.Struct("<QQ")
+CODEC_IDS = {"pickle": 0, "zlib": 1, "lzma": 2}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+
+SnapshotEntry = Tuple[str, str, bytes, int, float]
+
+
+class SnapshotMismatch(ValueError):
+    pass
+
+
+def config_fingerprint(source_config: Optional[Dict[str, Any]]) -> bytes:
+    return hashlib.sha1(json.dumps(source_config, sort_keys=True, default=str).encode()).digest()
+
+
+def key_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+
+def write_snapshot(path: str, entries: Iterable[SnapshotEntry], fingerprint: bytes, write_index: bool = False) -> int:
+    count = 0
+    offsets = []
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w+b") as snapshot:
+        snapshot.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, fingerprint, 0))
+        for key, codec, data, raw_size, expires_at in entries:
+            encoded_key = key.encode()
+            if write_index:
+                offsets.append((key_hash(key), snapshot.tell()))
+            snapshot.write(RECORD.pack(len(encoded_key), CODEC_IDS[codec], expires_at, len(data), raw_size))
+            snapshot.write(encoded_key)
+            snapshot.write(data)
+            count += 1
+        snapshot.seek(0)
+        snapshot.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, fingerprint, count))
+        snapshot.seek(0)
+        digest = hashlib.sha1()
+        for block in iter(lambda: snapshot.read(1 << 20), b""):
+            digest.update(block)
+        snapshot.write(digest.digest())
+        size = snapshot.tell()
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(tmp_path, path)
+    if write_index:
+        offsets.sort()
+        with open(f"{tmp_path}.idx", "wb") as index:
+            index.write(HEADER.pack(INDEX_MAGIC, SNAPSHOT_VERSION, fingerprint, count))
+            index.write(INDEX_BINDING.pack(size, digest.digest()))
+            for entry in offsets:
+                index.write(INDEX_ENTRY.pack(*entry))
+        os.replace(f"{tmp_path}.idx", f"{path}.idx")
+    return count
+
+
+def check_header(data: bytes, magic: bytes, fingerprint: bytes) -> int:
+    if len(data) < HEADER.size:
+        raise SnapshotMismatch("Snapshot is truncated")
+    found_magic, version, found_fingerprint, count = HEADER.unpack_from(data)
+    if found_magic != magic or version != SNAPSHOT_VERSION:
+        raise SnapshotMismatch(f"Unsupported snapshot format {found_magic!r} version {version}")
+    if found_fingerprint != fingerprint:
+        raise SnapshotMismatch("Snapshot was written for a different source config")
+    return count
+
+
+def read_record(data, offset: int) -> Tuple[int, SnapshotEntry]:
+    key_size, codec_id, expires_at, value_size, raw_size = RECORD.unpack_from(data, offset)
+    offset += RECORD.size
+    key = bytes(data[offset:offset + key_size]).decode()
+    offset += key_size
+    value = bytes(data[offset:offset + value_size])
+    return offset + value_size, (key, CODEC_NAMES[codec_id], value, raw_size, expires_at)
+
+
+def read_snapshot(path: str, fingerprint: bytes) -> Iterator[SnapshotEntry]:
+    with open(path, "rb") as snapshot, mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        count = check_header(data, SNAPSHOT_MAGIC, fingerprint)
+        offset = HEADER.size
+        for _ in range(count):
+            offset, entry = read_record(data, offset)
+            yield entry
+
+
+class SnapshotIndex:
+    def __init__(self, path: str, fingerprint: bytes):
+        with open(path, "rb") as snapshot:
+            self.data = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with open(f"{path}.idx", "rb") as index:
+                self.index = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.data.close()
+            raise
+        try:
+            check_header(self.data, SNAPSHOT_MAGIC, fingerprint)
+            self.count = check_header(self.index, INDEX_MAGIC, fingerprint)
+            size, digest = INDEX_BINDING.unpack_from(self.index, HEADER.size)
+            if size != len(self.data) or self.data[size - len(digest):size] != digest:
+                raise SnapshotMismatch("Index was written for another snapshot")
+        except Exception:
+            self.close()
+            raise
+
+    def index_entry(self, position: int) -> Tuple[int, int]:
+        return INDEX_ENTRY.unpack_from(self.index, HEADER.size + INDEX_BINDING.size + position * INDEX_ENTRY.size)
+
+    def get(self, key: str) -> Optional[SnapshotEntry]:
+        wanted = key_hash(key)
+        # Binary search straight over the mapped entries
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.index_entry(middle)[0] < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        position = low
+        while position < self.count:
+            found, offset = self.index_entry(position)
+            if found != wanted:
+                break
+            _, entry = read_record(self.data, offset)
+            if entry[0] == key:
+                return entry
+            position += 1
+        return None
+
+    def close(self) -> None:
+        self.data.close()
+        self.index.close()
+
+
 # database.py
 import abc
 import csv
+import hashlib
+import lzma
+import os
+import pickle
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional
 
 from pymongo import MongoClient
+from pymongo.errors import ExecutionTimeout
 from mysql.connector import connect, Error
 
+from context import Deadline, DeadlineExceeded, record_span
+from resilience import CircuitBreaker, CircuitOpenError
+from replicas import ReplicaRouter
+from snapshots import config_fingerprint, read_snapshot, write_snapshot
+
+MYSQL_QUERY_TIMEOUT = 3024
+
 
 class BaseClient(abc.ABC):
     @abc.abstractmethod
-    def get_document(self, document_id: str) -> dict:
+    def get_document(self, document_id: str, deadline: Optional[Deadline] = None) -> dict:
         raise NotImplementedError()
 
+    def get_documents(self, document_ids: List[str], deadline: Optional[Deadline] = None) -> Dict[str, dict]:
+        documents = {}
+        for document_id in document_ids:
+            if deadline is not None:
+                deadline.check()
+            documents[document_id] = self.get_document(document_id, deadline)
+        return documents
+
 
 class MySQLClient(BaseClient):
-    def __init__(self, ...) -> None:
+    def __init__(
+        self,
+        ...,
+        breaker: Optional[CircuitBreaker] = None,
+        router: Optional[ReplicaRouter] = None,
+        fetch_size: int = 256,
+        multi_row: bool = False
+    ) -> None:
+        self.breaker = breaker
+        self.router = router
+        self.fetch_size = fetch_size
+        # With multi_row every matching row is returned as a list, otherwise only one row
+        self.multi_row = multi_row
+        self.row_types: Dict[tuple, type] = {}
         self.client = None
         self.host = None
         self.user = None
@@ -23,30 +612,135 @@ class MySQLClient(BaseClient):
     
     def select_table(self, table_name: str) -> None:
         self.table = table_name
+
+    def connect(self, endpoint: Optional[Dict[str, Any]] = None):
+        if endpoint is not None:
+            return connect(**endpoint)
+        return connect(
+            host=self.host,
+            user=self.user,
+            password=self.password,
+            database=self.database
+        )
+
+    @staticmethod
+    def ping(endpoint: Dict[str, Any]) -> None:
+        try:
+            connect(**endpoint).close()
+        except Error as e:
+            raise ConnectionError(f"Cannot reach the replica: {repr(e)}")
     
-    def get_document(self, document_id: str) -> dict:
+    def get_document(self, document_id: str, deadline: Optional[Deadline] = None) -> dict:
+        if deadline is not None:
+            deadline.check()
+        started = time.perf_counter()
+        if self.breaker is None:
+            document = self.read(self.query_document, document_id, deadline)
+        else:
+            document = self.breaker.call(self.read, self.query_document, document_id, deadline)
+        record_span("mysql", started, bool(document))
+        return document
+
+    def get_documents(self, document_ids: List[str], deadline: Optional[Deadline] = None) -> Dict[str, dict]:
+        if deadline is not None:
+            deadline.check()
+        if self.breaker is None:
+            return self.read(self.query_documents, document_ids, deadline)
+        return self.breaker.call(self.read, self.query_documents, document_ids, deadline)
+
+    def read(self, func, *args):
+        if self.router is None:
+            return func(None, *args)
+        return self.router.call(func, *args)
+
+    def query_document(
+        self,
+        endpoint: Optional[Dict[str, Any]],
+        document_id: str,
+        deadline: Optional[Deadline] = None
+    ) -> dict:
         document = {}
+        limit = "" if self.multi_row else " LIMIT 1"
+        query = f"SELECT {self.execution_hint(deadline)}* from {self.table} where document_id = %s{limit}"
         try:
-            with connect(
-                host=self.host,
-                user=self.user,
-                password=self.password,
-                database=self.database
-            ) as conn:
-                query = f"SELECT * from {self.table} where document_id == {document_id}"
+            with self.connect(endpoint) as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute(query)
-                    result = cursor.fetchall()
-                    for row in result:
-                        document[document_id] = row
+                    cursor.execute(query, (document_id,))
+                    rows = list(self.stream_rows(cursor))
         except Error as e:
+            if e.errno == MYSQL_QUERY_TIMEOUT:
+                raise DeadlineExceeded(f"Query interrupted: {repr(e)}")
             raise ConnectionError(f"Cannot get the document: {repr(e)}")
+        if rows:
+            document[document_id] = rows if self.multi_row else rows[0]
         return document
 
+    def query_documents(
+        self,
+        endpoint: Optional[Dict[str, Any]],
+        document_ids: List[str],
+        deadline: Optional[Deadline] = None
+    ) -> Dict[str, dict]:
+        documents: Dict[str, dict] = {document_id: {} for document_id in document_ids}
+        if not document_ids:
+            return documents
+        try:
+            with self.connect(endpoint) as conn:
+                placeholders = ", ".join(["%s"] * len(document_ids))
+                hint = self.execution_hint(deadline)
+                query = f"SELECT {hint}* from {self.table} where document_id IN ({placeholders})"
+                with conn.cursor() as cursor:
+                    cursor.execute(query, tuple(document_ids))
+                    for row in self.stream_rows(cursor):
+                        document_id = str(row.document_id)
+                        if not self.multi_row:
+                            documents[document_id] = {document_id: row}
+                        elif documents.get(document_id):
+                            documents[document_id][document_id].append(row)
+                        else:
+                            documents[document_id] = {document_id: [row]}
+        except Error as e:
+            if e.errno == MYSQL_QUERY_TIMEOUT:
+                raise DeadlineExceeded(f"Query interrupted: {repr(e)}")
+            raise ConnectionError(f"Cannot get the documents: {repr(e)}")
+        return documents
+
+    @staticmethod
+    def execution_hint(deadline: Optional[Deadline]) -> str:
+        # Lets the server abort the query itself once the caller's budget is spent
+        if deadline is None or deadline.remaining() is None:
+            return ""
+        return f"/*+ MAX_EXECUTION_TIME({deadline.remaining_ms()}) */ "
+
+    def stream_rows(self, cursor) -> Iterator[tuple]:
+        row_type = self.row_type(cursor.description)
+        while True:
+            rows = cursor.fetchmany(self.fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row_type._make(row)
+
+    def row_type(self, description) -> type:
+        columns = tuple(column[0] for column in description)
+        row_type = self.row_types.get(columns)
+        if row_type is None:
+            row_type = namedtuple("Row", columns, rename=True)
+            self.row_types[columns] = row_type
+        return row_type
+
 
 class MongoClient(BaseClient):
-    def __init__(self, next_resp: BaseClient, ...):
+    def __init__(
+        self,
+        next_resp: BaseClient,
+        ...,
+        breaker: Optional[CircuitBreaker] = None,
+        router: Optional[ReplicaRouter] = None
+    ):
         self.next_resp = next_resp
+        self.breaker = breaker
+        self.router = router
         self.client = None
         self.coll = None
         self.db = None
@@ -61,94 +755,2912 @@ class MongoClient(BaseClient):
     def select_collection(self, coll: str):
         self.coll = coll
 
-    def get_document(self, document_id: str) -> dict:
-        document = self.coll.find_one({"_id": document_id})
-        if not document:
-            document = self.next_resp.get_document(document_id)
+    @staticmethod
+    def ping(coll) -> None:
+        coll.database.client.admin.command("ping")
+
+    def get_document(self, document_id: str, deadline: Optional[Deadline] = None) -> dict:
+        max_time_ms = None
+        if deadline is not None:
+            deadline.check()
+            max_time_ms = deadline.remaining_ms()
+        started = time.perf_counter()
+        try:
+            document = self.call(
+                self.read, lambda coll: coll.find_one({"_id": document_id}, max_time_ms=max_time_ms)
+            )
+        except CircuitOpenError:
+            # Skip the slow backend and go straight to the next tier
+            document = None
+        record_span("mongo", started, bool(document))
+        if not document and self.next_resp is not None:
+            document = self.next_resp.get_document(document_id, deadline)
         return document
 
+    def get_documents(self, document_ids: List[str], deadline: Optional[Deadline] = None) -> Dict[str, dict]:
+        max_time_ms = None
+        if deadline is not None:
+            deadline.check()
+            max_time_ms = deadline.remaining_ms()
+        documents: Dict[str, dict] = {}
+        try:
+            found = self.call(
+                self.read,
+                lambda coll: list(coll.find({"_id": {"$in": document_ids}}, max_time_ms=max_time_ms))
+            )
+        except CircuitOpenError:
+            found = []
+        for document in found:
+            documents[document["_id"]] = document
+        missing = [document_id for document_id in document_ids if not documents.get(document_id)]
+        if missing and self.next_resp is not None:
+            documents.update(self.next_resp.get_documents(missing, deadline))
+        return documents
+
+    def call(self, func, *args):
+        if self.breaker is None:
+            return func(*args)
+        return self.breaker.call(func, *args)
+
+    def read(self, func):
+        # Converted here so the breaker sees the timeout as the caller's deadline running out
+        try:
+            if self.router is None:
+                return func(self.coll)
+            return self.router.call(lambda endpoint: func(self.coll if endpoint is None else endpoint))
+        except ExecutionTimeout as e:
+            raise DeadlineExceeded(f"Query interrupted: {repr(e)}")
+
 
 class CSVReader(BaseClient):
-    def __init__(self, file_name: str):
+    def __init__(self, file_name: str, check_every: int = 1024):
         self.file_name = file_name
+        # Rows scanned between two deadline checks
+        self.check_every = check_every
 
-    def get_document(self, document_id: str):
+    def get_document(self, document_id: str, deadline: Optional[Deadline] = None):
         document = {}
+        started = time.perf_counter()
         with open(self.file_name, newline='') as csv_file:
             spamreader = csv.DictReader(csv_file)
-            for row in spamreader:
+            for index, row in enumerate(spamreader):
+                if deadline is not None and index % self.check_every == 0:
+                    deadline.check()
                 if row['document_id'] == document_id:
                     document[document_id] = row['content']
                     break
+        record_span("csv", started, bool(document))
         return document
 
+    def get_documents(self, document_ids: List[str], deadline: Optional[Deadline] = None) -> Dict[str, dict]:
+        documents: Dict[str, dict] = {document_id: {} for document_id in document_ids}
+        remaining = set(document_ids)
+        with open(self.file_name, newline='') as csv_file:
+            spamreader = csv.DictReader(csv_file)
+            for index, row in enumerate(spamreader):
+                if deadline is not None and index % self.check_every == 0:
+                    deadline.check()
+                if row['document_id'] in remaining:
+                    remaining.discard(row['document_id'])
+                    documents[row['document_id']] = {row['document_id']: row['content']}
+                    if not remaining:
+                        break
+        return documents
+
+
+class ChangeFeed(abc.ABC):
+    @abc.abstractmethod
+    def poll(self) -> Dict[str, Any]:
+        # Returns {document_id: version}; a None version means the document was deleted
+        raise NotImplementedError()
+
+
+class MongoChangeFeed(ChangeFeed):
+    def __init__(self, client: MongoClient, max_events: int = 1000):
+        self.client = client
+        self.max_events = max_events
+        self.resume_token = None
+        self.stream = None
+
+    def poll(self) -> Dict[str, Any]:
+        changes = {}
+        try:
+            if self.stream is None:
+                self.stream = self.client.coll.watch(resume_after=self.resume_token)
+            for _ in range(self.max_events):
+                change = self.stream.try_next()
+                if change is None:
+                    break
+                version = change.get("clusterTime")
+                if change["operationType"] == "delete":
+                    version = None
+                changes[change["documentKey"]["_id"]] = version
+            self.resume_token = self.stream.resume_token
+        except Exception as e:
+            self.stream = None
+            raise ConnectionError(f"Cannot read the change stream: {repr(e)}")
+        return changes
+
+
+class MySQLChangeFeed(ChangeFeed):
+    def __init__(self, client: MySQLClient, version_column: str = "updated_at"):
+        self.client = client
+        self.version_column = version_column
+        self.last_version = None
+        # IDs already emitted with version == last_version
+        self.seen: set = set()
+
+    def poll(self) -> Dict[str, Any]:
+        changes = {}
+        try:
+            with self.client.connect() as conn:
+                with conn.cursor() as cursor:
+                    if self.last_version is None:
+                        cursor.execute(f"SELECT MAX({self.version_column}) FROM {self.client.table}")
+                        self.last_version = cursor.fetchone()[0]
+                        if self.last_version is not None:
+                            cursor.execute(
+                                f"SELECT document_id FROM {self.client.table} WHERE {self.version_column} = %s",
+                                (self.last_version,)
+                            )
+                            self.seen = {str(row[0]) for row in cursor}
+                        return changes
+                    # ">=" re-reads rows sharing the watermark so rows written later in the
+                    # same tick are not missed; the ones already emitted are skipped
+                    cursor.execute(
+                        f"SELECT document_id, {self.version_column} FROM {self.client.table} "
+                        f"WHERE {self.version_column} >= %s ORDER BY {self.version_column}",
+                        (self.last_version,)
+                    )
+                    last_version, seen = self.last_version, set(self.seen)
+                    for document_id, version in cursor:
+                        document_id = str(document_id)
+                        if version != last_version:
+                            last_version, seen = version, set()
+                        elif document_id in seen:
+                            continue
+                        seen.add(document_id)
+                        changes[document_id] = version
+        except Error as e:
+            raise ConnectionError(f"Cannot poll the changes: {repr(e)}")
+        self.last_version, self.seen = last_version, seen
+        return changes
+
+
+class CSVChangeFeed(ChangeFeed):
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.mtime = None
+        self.digests: Dict[str, str] = {}
+
+    def poll(self) -> Dict[str, Any]:
+        mtime = os.stat(self.file_name).st_mtime_ns
+        if mtime == self.mtime:
+            return {}
+        digests: Dict[str, str] = {}
+        with open(self.file_name, newline='') as csv_file:
+            spamreader = csv.DictReader(csv_file)
+            for row in spamreader:
+                digest = hashlib.blake2b(row['content'].encode(), digest_size=8).hexdigest()
+                digests.setdefault(row['document_id'], digest)
+        changes: Dict[str, Any] = {}
+        if self.mtime is not None:
+            for document_id, digest in digests.items():
+                if self.digests.get(document_id) != digest:
+                    changes[document_id] = digest
+            for document_id in self.digests.keys() - digests.keys():
+                changes[document_id] = None
+        self.mtime = mtime
+        self.digests = digests
+        return changes
+
+
+class LocalChangeFeed(ChangeFeed):
+    def __init__(self):
+        self.changes: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+
+    def publish(self, document_id: str, version: Any = None) -> None:
+        with self.lock:
+            self.changes[document_id] = version
+
+    def poll(self) -> Dict[str, Any]:
+        with self.lock:
+            changes, self.changes = self.changes, {}
+        return changes
+
+
+CODECS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress)
+}
+
+
+class StoredValue:
+    __slots__ = ("codec", "data")
+
+    def __init__(self, codec: str, data: bytes):
+        self.codec = codec
+        self.data = data
+
 
 class CacheReader(BaseClient):
-    def __init__(self, client: BaseClient):
-        self.cache: dict = {}
+    def __init__(
+        self,
+        client: BaseClient,
+        change_feed: Optional[ChangeFeed] = None,
+        refresh_on_change: bool = False,
+        sync_interval: float = 1.0,
+        ttl: Optional[float] = None,
+        stale_while_revalidate: bool = False,
+        refresh_ahead: float = 0.0,
+        refresh_ahead_min_hits: int = 2,
+        max_background_refreshes: int = 4,
+        latency_window: int = 10000,
+        compression: Optional[str] = None,
+        compress_threshold: int = 1024,
+        max_bytes: Optional[int] = None,
+        snapshot_path: Optional[str] = None,
+        source_config: Optional[Dict[str, Any]] = None
+    ):
+        if compression is not None and compression != "pickle" and compression not in CODECS:
+            raise ValueError(f"Unknown compression: {compression}")
+        self.cache: OrderedDict = OrderedDict()
+        self.sizes: dict = {}
+        self.versions: dict = {}
+        self.expires: dict = {}
+        self.hits: dict = {}
         self.client = client
+        self.change_feed = change_feed
+        self.refresh_on_change = refresh_on_change
+        self.sync_interval = sync_interval
+        self.last_sync = 0.0
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        # Fraction of the ttl left at which hot entries are refreshed in the background
+        self.refresh_ahead = refresh_ahead
+        self.refresh_ahead_min_hits = refresh_ahead_min_hits
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.refreshing: set = set()
+        self.refresh_slots = threading.BoundedSemaphore(max_background_refreshes)
+        self.executor = ThreadPoolExecutor(max_workers=max_background_refreshes)
+        self.latencies: deque = deque(maxlen=latency_window)
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.max_bytes = max_bytes
+        self.stored_bytes = 0
+        self.raw_bytes = 0
+        self.snapshot_path = snapshot_path
+        # Snapshots taken against a different backend config are rejected on load
+        self.fingerprint = config_fingerprint(source_config)
+        self.snapshot_stopped = threading.Event()
+        self.stats: Dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "stale_hits": 0,
+            "refresh_ahead": 0,
+            "refresh_errors": 0,
+            "evictions": 0,
+            "snapshot_errors": 0,
+            "feed_errors": 0
+        }
     
-    def get_document(self, document_id: str) -> dict:
-        if document_id not in self.cache:
-            self.cache[document_id] = self.client.get_document(document_id)
-        document = self.cache[document_id]
+    def get_document(self, document_id: str, deadline: Optional[Deadline] = None) -> dict:
+        start = time.perf_counter()
+        if self.change_feed is not None and time.monotonic() - self.last_sync >= self.sync_interval:
+            self.try_sync_changes()
+        with self.lock:
+            cached = document_id in self.cache
+            stored = self.cache.get(document_id)
+            expires_at = self.expires.get(document_id)
+            if cached:
+                self.hits[document_id] = self.hits.get(document_id, 0) + 1
+                hits = self.hits[document_id]
+                if self.max_bytes is not None:
+                    self.cache.move_to_end(document_id)
+        document = self.decode(stored) if cached else None
+        fetched = not cached
+        now = time.monotonic()
+        if not cached:
+            self.stats["misses"] += 1
+            document = self.fetch(document_id, deadline)
+        elif expires_at is not None and now >= expires_at:
+            if self.stale_while_revalidate and self.schedule_refresh(document_id):
+                self.stats["stale_hits"] += 1
+            else:
+                try:
+                    document = self.fetch(document_id, deadline)
+                    fetched = True
+                    self.stats["misses"] += 1
+                except ConnectionError:
+                    # Backend unavailable (or its circuit is open), keep serving the expired entry
+                    self.stats["stale_hits"] += 1
+        else:
+            self.stats["hits"] += 1
+            if (
+                expires_at is not None
+                and self.ttl is not None
+                and self.refresh_ahead > 0
+                and expires_at - now <= self.ttl * self.refresh_ahead
+                and hits >= self.refresh_ahead_min_hits
+                and self.schedule_refresh(document_id)
+            ):
+                self.stats["refresh_ahead"] += 1
+        self.latencies.append(time.perf_counter() - start)
+        record_span("cache", start, not fetched)
         return document
 
+    def fetch(self, document_id: str, deadline: Optional[Deadline] = None) -> dict:
+        document = self.client.get_document(document_id, deadline)
+        stored, size, raw_size = self.encode(document)
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        self.insert(document_id, stored, size, raw_size, expires_at)
+        return document
 
-# cliente.py
-from typing import Dict, List, Any
-from database import MongoClient, CacheReader, BaseClient, CSVReader
+    def insert(self, document_id: str, stored: Any, size: int, raw_size: int, expires_at: Optional[float]) -> None:
+        with self.lock:
+            self.forget(document_id, keep_stats=True)
+            self.cache[document_id] = stored
+            self.sizes[document_id] = (size, raw_size)
+            self.stored_bytes += size
+            self.raw_bytes += raw_size
+            self.hits[document_id] = 0
+            if expires_at is not None:
+                self.expires[document_id] = expires_at
+            if self.max_bytes is not None:
+                while self.stored_bytes > self.max_bytes and len(self.cache) > 1:
+                    evicted_id = next(iter(self.cache))
+                    self.forget(evicted_id)
+                    self.stats["evictions"] += 1
 
+    def encode(self, document: dict):
+        if self.compression is None:
+            if self.max_bytes is None:
+                return document, 0, 0
+            size = len(pickle.dumps(document, pickle.HIGHEST_PROTOCOL))
+            return document, size, size
+        data = pickle.dumps(document, pickle.HIGHEST_PROTOCOL)
+        raw_size = len(data)
+        codec = "pickle"
+        if self.compression in CODECS and raw_size >= self.compress_threshold:
+            compressed = CODECS[self.compression][0](data)
+            if len(compressed) < raw_size:
+                data, codec = compressed, self.compression
+        return StoredValue(codec, data), len(data), raw_size
 
-class APP:
-    def __init__(self, client: BaseClient):
+    def decode(self, stored: Any) -> dict:
+        if not isinstance(stored, StoredValue):
+            return stored
+        data = stored.data
+        if stored.codec != "pickle":
+            data = CODECS[stored.codec][1](data)
+        return pickle.loads(data)
+
+    def forget(self, document_id: str, keep_stats: bool = False) -> None:
+        # Must be called with self.lock held
+        self.cache.pop(document_id, None)
+        size, raw_size = self.sizes.pop(document_id, (0, 0))
+        self.stored_bytes -= size
+        self.raw_bytes -= raw_size
+        if not keep_stats:
+            self.expires.pop(document_id, None)
+            self.hits.pop(document_id, None)
+            self.versions.pop(document_id, None)
+
+    def save_snapshot(self, write_index: bool = False) -> int:
+        if self.snapshot_path is None:
+            return 0
+        # Copy the entry references under the lock, serialize outside of it
+        with self.lock:
+            items = list(self.cache.items())
+            expires = dict(self.expires)
+            sizes = dict(self.sizes)
+        now = time.monotonic()
+        # Expiry is stored as wall-clock time so downtime between save and load counts against the ttl
+        wall_now = time.time()
+
+        def entries():
+            for document_id, stored in items:
+                if not isinstance(stored, StoredValue):
+                    stored = StoredValue("pickle", pickle.dumps(stored, pickle.HIGHEST_PROTOCOL))
+                raw_size = sizes.get(document_id, (0, 0))[1] or len(stored.data)
+                expires_at = expires.get(document_id)
+                if expires_at is not None:
+                    expires_at = wall_now + max(0.0, expires_at - now)
+                yield document_id, stored.codec, stored.data, raw_size, -1.0 if expires_at is None else expires_at
+
+        return write_snapshot(self.snapshot_path, entries(), self.fingerprint, write_index)
+
+    def load_snapshot(self) -> int:
+        if self.snapshot_path is None or not os.path.exists(self.snapshot_path):
+            return 0
+        loaded = 0
+        now = time.monotonic()
+        wall_now = time.time()
+        for document_id, codec, data, raw_size, expires_at in read_snapshot(self.snapshot_path, self.fingerprint):
+            if 0 <= expires_at <= wall_now:
+                continue
+            stored: Any = StoredValue(codec, data)
+            size = len(data)
+            if self.compression is None:
+                stored = self.decode(stored)
+                if self.max_bytes is None:
+                    size = raw_size = 0
+            self.insert(document_id, stored, size, raw_size, None if expires_at < 0 else now + expires_at - wall_now)
+            loaded += 1
+        return loaded
+
+    def start_snapshots(self, interval: float, write_index: bool = False) -> threading.Thread:
+        def run():
+            while not self.snapshot_stopped.wait(interval):
+                try:
+                    self.save_snapshot(write_index)
+                except Exception:
+                    self.stats["snapshot_errors"] += 1
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop_snapshots(self) -> None:
+        self.snapshot_stopped.set()
+
+    def memory_usage(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.cache),
+            "stored_bytes": self.stored_bytes,
+            "raw_bytes": self.raw_bytes,
+            "compression_ratio": self.raw_bytes / self.stored_bytes if self.stored_bytes else 1.0,
+            "max_bytes": self.max_bytes,
+            "sized": self.compression is not None or self.max_bytes is not None
+        }
+
+    def schedule_refresh(self, document_id: str) -> bool:
+        with self.lock:
+            if document_id in self.refreshing:
+                return True
+            if not self.refresh_slots.acquire(blocking=False):
+                return False
+            self.refreshing.add(document_id)
+        self.executor.submit(self.background_refresh, document_id)
+        return True
+
+    def background_refresh(self, document_id: str) -> None:
+        try:
+            self.fetch(document_id)
+        except Exception:
+            self.stats["refresh_errors"] += 1
+        finally:
+            with self.lock:
+                self.refreshing.discard(document_id)
+            self.refresh_slots.release()
+
+    def latency_percentile(self, percentile: float) -> float:
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return 0.0
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+    def metrics(self) -> Dict[str, Any]:
+        metrics: Dict[str, Any] = dict(self.stats)
+        metrics["size"] = len(self.cache)
+        metrics["refreshing"] = len(self.refreshing)
+        metrics["p50"] = self.latency_percentile(50)
+        metrics["p99"] = self.latency_percentile(99)
+        metrics.update(self.memory_usage())
+        return metrics
+
+    def try_sync_changes(self) -> None:
+        # Only one request polls the feed, the others carry on with what is cached
+        if not self.sync_lock.acquire(blocking=False):
+            return
+        try:
+            self.sync_changes()
+        except Exception:
+            self.stats["feed_errors"] += 1
+        finally:
+            self.sync_lock.release()
+
+    def sync_changes(self) -> List[str]:
+        self.last_sync = time.monotonic()
+        changed = []
+        for document_id, version in self.change_feed.poll().items():
+            with self.lock:
+                if version is not None and self.versions.get(document_id) == version:
+                    continue
+                if document_id not in self.cache:
+                    continue
+                refresh = self.refresh_on_change and version is not None
+                if refresh:
+                    self.versions[document_id] = version
+                else:
+                    self.forget(document_id)
+            # Refreshes run on the background pool; without a free slot the entry is evicted instead
+            if refresh and not self.schedule_refresh(document_id):
+                with self.lock:
+                    self.forget(document_id)
+            changed.append(document_id)
+        return changed
+
+
+# batching.py
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional
+
+from context import Deadline, DeadlineExceeded
+from database import BaseClient
+
+
+class MicroBatcher(BaseClient):
+    def __init__(
+        self,
+        client: BaseClient,
+        max_batch_size: int = 64,
+        max_wait: float = 0.005,
+        latency_target: float = 0.05
+    ):
         self.client = client
-    
-    def get_documents_from_ids(self, documents_id: List[str]) -> dict:
-        products = {}
-        for document_id in documents_id:
-            products[document_id] = self.client.get_document(document_id)
-        return products
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.min_wait = max_wait / 16
+        self.latency_target = latency_target
+        self.wait = max_wait
+        self.backend_latency = 0.0
+        self.pending: Dict[str, List[Future]] = {}
+        self.condition = threading.Condition()
+        self.closed = False
+        self.stats: Dict[str, int] = {"batches": 0, "documents": 0}
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
 
-    @classmethod
-    def create_app_chain_responsability(
-        cls,
-        use_cache: bool,
-        db_client_config: Dict[str, Any],
-        csv_reader_config: Dict[str, Any]
-    ) -> 'APP':
-        client = MongoClient(CSVReader(**csv_reader_config), **db_client_config)
-        if use_cache:
-            cache = CacheReader(client)
-            return cls(cache)
-        return cls(client)
+    def get_document(self, document_id: str, deadline: Optional[Deadline] = None) -> dict:
+        future = self.submit(document_id)
+        try:
+            return future.result(timeout=None if deadline is None else deadline.remaining())
+        except FutureTimeoutError:
+            # Drops the lookup from the batch if it has not been sent yet
+            future.cancel()
+            raise DeadlineExceeded(f"Deadline exceeded waiting for document {document_id}")
 
-    @classmethod
-    def create_app_use_mongo(cls, use_cache: bool, db_client_config: Dict[str, Any]) -> 'APP':
-        client = MongoClient(**db_client_config)
-        if use_cache:
-            cache = CacheReader(client)
-            return cls(cache)
-        return cls(client)
+    def get_documents(self, document_ids: List[str], deadline: Optional[Deadline] = None) -> Dict[str, dict]:
+        if deadline is not None:
+            deadline.check()
+        # Submit everything first so the IDs share windows instead of waiting one window each
+        futures = {document_id: self.submit(document_id) for document_id in dict.fromkeys(document_ids)}
+        found: Dict[str, dict] = {}
+        try:
+            for document_id, future in futures.items():
+                found[document_id] = future.result(timeout=None if deadline is None else deadline.remaining())
+        except FutureTimeoutError:
+            for future in futures.values():
+                future.cancel()
+            raise DeadlineExceeded(f"Deadline exceeded waiting for {len(futures) - len(found)} documents")
+        return {document_id: found[document_id] for document_id in document_ids}
 
-    @classmethod
-    def create_app_use_csvreader(cls, use_cache: bool, csv_reader_config: Dict[str, Any]) -> 'APP':
-        client = CSVReader(**csv_reader_config)
-        if use_cache:
-            cache = CacheReader(client)
-            return cls(cache)
-        return cls(client)
+    async def aget_document(self, document_id: str) -> dict:
+        return await asyncio.wrap_future(self.submit(document_id))
 
+    def submit(self, document_id: str) -> Future:
+        future: Future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("MicroBatcher is closed")
+            self.pending.setdefault(document_id, []).append(future)
+            if len(self.pending) == 1 or len(self.pending) >= self.max_batch_size:
+                self.condition.notify()
+        return future
 
-# Con Mongodb
-mongo_config = {....}
-mongo_client = MongoClient(**mongo_config)
-my_app = APP(mongo_client)
-# Con CSV
-csv_config = {....}
-csv_client = CSVReader(**csv_config)
-my_app = APP(csv_client)
-# Con MySQL
-sql_config = {....}
-sql_client = MySQLClient(**sql_config)
-my_app = APP(sql_client)
\ No newline at end of file
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if self.closed and not self.pending:
+                    return
+                window_end = time.monotonic() + self.wait
+                while len(self.pending) < self.max_batch_size and not self.closed:
+                    remaining = window_end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                document_ids = list(self.pending)[:self.max_batch_size]
+                batch = {document_id: self.pending.pop(document_id) for document_id in document_ids}
+            self.flush(batch)
+
+    def flush(self, batch: Dict[str, List[Future]]) -> None:
+        futures = {
+            document_id: [future for future in waiting if future.set_running_or_notify_cancel()]
+            for document_id, waiting in batch.items()
+        }
+        futures = {document_id: waiting for document_id, waiting in futures.items() if waiting}
+        if not futures:
+            return
+        start = time.perf_counter()
+        try:
+            documents = self.client.get_documents(list(futures))
+        except Exception as e:
+            for waiting in futures.values():
+                for future in waiting:
+                    future.set_exception(e)
+            return
+        finally:
+            self.adapt(len(futures), time.perf_counter() - start)
+        for document_id, waiting in futures.items():
+            for future in waiting:
+                future.set_result(documents.get(document_id, {}))
+
+    def adapt(self, batch_size: int, latency: float) -> None:
+        self.stats["batches"] += 1
+        self.stats["documents"] += batch_size
+        self.backend_latency = 0.8 * self.backend_latency + 0.2 * latency
+        if batch_size <= 1:
+            # Nobody else showed up during the window, waiting only adds latency
+            self.wait /= 2
+        elif batch_size < self.max_batch_size:
+            self.wait *= 1.25
+        budget = min(self.max_wait, max(0.0, self.latency_target - self.backend_latency))
+        self.wait = min(max(self.wait, self.min_wait), budget)
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.worker.join()
+
+
+# sharding.py
+import abc
+import bisect
+import hashlib
+import multiprocessing
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from context import Deadline
+from database import BaseClient
+
+
+class CacheNode(abc.ABC):
+    @abc.abstractmethod
+    def get(self, document_id: str) -> Optional[dict]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def set(self, document_id: str, document: dict) -> None:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def delete(self, document_id: str) -> None:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def keys(self) -> List[str]:
+        raise NotImplementedError()
+
+
+class LocalCacheNode(CacheNode):
+    def __init__(self):
+        self.store: Dict[str, dict] = {}
+
+    def get(self, document_id: str) -> Optional[dict]:
+        return self.store.get(document_id)
+
+    def set(self, document_id: str, document: dict) -> None:
+        self.store[document_id] = document
+
+    def delete(self, document_id: str) -> None:
+        self.store.pop(document_id, None)
+
+    def keys(self) -> List[str]:
+        return list(self.store.keys())
+
+
+class ProcessCacheNode(LocalCacheNode):
+    # Keeps its entries in a separate server process, standing in for a remote cache node
+    def __init__(self):
+        self.manager = multiprocessing.Manager()
+        self.store = self.manager.dict()
+
+    def close(self) -> None:
+        self.manager.shutdown()
+
+
+class ConsistentHashRing:
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = 100):
+        self.vnodes = vnodes
+        self.ring: List[int] = []
+        self.owners: Dict[int, str] = {}
+        self.lock = threading.Lock()
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def add(self, node: str) -> None:
+        with self.lock:
+            for replica in range(self.vnodes):
+                point = self.hash(f"{node}#{replica}")
+                if point not in self.owners:
+                    bisect.insort(self.ring, point)
+                    self.owners[point] = node
+
+    def remove(self, node: str) -> None:
+        with self.lock:
+            points = [point for point, owner in self.owners.items() if owner == node]
+            for point in points:
+                del self.owners[point]
+            self.ring = [point for point in self.ring if point in self.owners]
+
+    def get_node(self, key: str) -> str:
+        with self.lock:
+            if not self.ring:
+                raise LookupError("The hash ring has no nodes")
+            index = bisect.bisect(self.ring, self.hash(key)) % len(self.ring)
+            return self.owners[self.ring[index]]
+
+
+class ShardedCacheClient(BaseClient):
+    def __init__(self, client: BaseClient, nodes: Dict[str, CacheNode], vnodes: int = 100):
+        self.client = client
+        self.nodes = dict(nodes)
+        self.ring = ConsistentHashRing(self.nodes, vnodes=vnodes)
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "moved": 0}
+
+    def get_document(self, document_id: str, deadline: Optional[Deadline] = None) -> dict:
+        node = None
+        while node is None:
+            # A node leaving between the two lookups is already off the ring, so look again
+            node = self.nodes.get(self.ring.get_node(document_id))
+        document = node.get(document_id)
+        if document is None:
+            self.stats["misses"] += 1
+            document = self.client.get_document(document_id, deadline)
+            node.set(document_id, document)
+        else:
+            self.stats["hits"] += 1
+        return document
+
+    def add_node(self, name: str, node: CacheNode) -> int:
+        # Nodes are registered before they join the ring and leave the ring before they
+        # are dropped, so every name the ring hands out can be resolved
+        others = list(self.nodes.values())
+        self.nodes[name] = node
+        self.ring.add(name)
+        moved = 0
+        for other in others:
+            for document_id in other.keys():
+                if self.ring.get_node(document_id) != name:
+                    continue
+                document = other.get(document_id)
+                if document is not None:
+                    node.set(document_id, document)
+                    moved += 1
+                other.delete(document_id)
+        self.stats["moved"] += moved
+        return moved
+
+    def remove_node(self, name: str) -> int:
+        node = self.nodes[name]
+        self.ring.remove(name)
+        moved = 0
+        if len(self.nodes) > 1:
+            for document_id in node.keys():
+                document = node.get(document_id)
+                if document is not None:
+                    self.nodes[self.ring.get_node(document_id)].set(document_id, document)
+                    moved += 1
+        del self.nodes[name]
+        self.stats["moved"] += moved
+        return moved
+
+
+# csv_store.py
+import csv
+import hashlib
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from context import Deadline, record_span
+from database import BaseClient
+
+
+class SQLiteCSVStore(BaseClient):
+    def __init__(
+        self,
+        file_name: str,
+        db_path: str = ":memory:",
+        chunk_size: int = 10000,
+        check_interval: float = 1.0
+    ):
+        self.file_name = file_name
+        self.chunk_size = chunk_size
+        self.check_interval = check_interval
+        self.last_check = 0.0
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS documents (document_id TEXT NOT NULL, content TEXT)")
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS documents_document_id ON documents (document_id)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS import_state ("
+            "file_name TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+            "offset INTEGER, fingerprint TEXT, fieldnames TEXT)"
+        )
+        self.conn.commit()
+        self.refresh()
+
+    def get_document(self, document_id: str, deadline: Optional[Deadline] = None) -> dict:
+        if deadline is not None:
+            deadline.check()
+        self.refresh_if_due()
+        document = {}
+        started = time.perf_counter()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT content FROM documents WHERE document_id = ?", (document_id,)
+            ).fetchone()
+        if row is not None:
+            document[document_id] = row[0]
+        record_span("csv_store", started, bool(document))
+        return document
+
+    def get_documents(self, document_ids: List[str], deadline: Optional[Deadline] = None) -> Dict[str, dict]:
+        self.refresh_if_due()
+        documents: Dict[str, dict] = {document_id: {} for document_id in document_ids}
+        unique_ids = list(dict.fromkeys(document_ids))
+        # Stay below SQLite's default limit of bound parameters per statement
+        for start in range(0, len(unique_ids), 500):
+            if deadline is not None:
+                deadline.check()
+            chunk = unique_ids[start:start + 500]
+            placeholders = ", ".join(["?"] * len(chunk))
+            with self.lock:
+                rows = self.conn.execute(
+                    f"SELECT document_id, content FROM documents WHERE document_id IN ({placeholders})", chunk
+                ).fetchall()
+            for document_id, content in rows:
+                documents[document_id] = {document_id: content}
+        return documents
+
+    def refresh_if_due(self) -> None:
+        if time.monotonic() - self.last_check >= self.check_interval:
+            self.refresh()
+
+    def refresh(self) -> int:
+        with self.lock:
+            self.last_check = time.monotonic()
+            stat = os.stat(self.file_name)
+            state = self.conn.execute(
+                "SELECT size, mtime_ns, offset, fingerprint, fieldnames FROM import_state WHERE file_name = ?",
+                (self.file_name,)
+            ).fetchone()
+            if state is None:
+                return self.import_rows(0, None)
+            size, mtime_ns, offset, fingerprint, fieldnames = state
+            if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+                return 0
+            if stat.st_size > size and self.fingerprint(offset) == fingerprint:
+                # The file grew and the imported part is untouched, import the tail
+                return self.import_rows(offset, fieldnames.split(",") if offset else None)
+            return self.import_rows(0, None)
+
+    def fingerprint(self, offset: int) -> str:
+        # Hash the whole imported prefix so an edit anywhere in it forces a full import
+        digest = hashlib.sha1()
+        with open(self.file_name, "rb") as raw:
+            remaining = offset
+            while remaining > 0:
+                block = raw.read(min(remaining, 1 << 20))
+                if not block:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+        return digest.hexdigest()
+
+    def complete_end(self, raw, offset: int, size: int) -> int:
+        # Position right after the last newline, a writer may still be appending the line after it
+        position = size
+        while position > offset:
+            start = max(offset, position - 65536)
+            raw.seek(start)
+            newline = raw.read(position - start).rfind(b"\n")
+            if newline >= 0:
+                return start + newline + 1
+            position = start
+        return offset
+
+    def import_rows(self, offset: int, fieldnames) -> int:
+        imported = 0
+        with open(self.file_name, "rb") as raw, self.conn:
+            # Taken before reading, so rows appended meanwhile show up as a change on the next refresh
+            stat = os.fstat(raw.fileno())
+            end = self.complete_end(raw, offset, stat.st_size)
+            raw.seek(offset)
+
+            def lines():
+                while raw.tell() < end:
+                    yield raw.readline().decode()
+
+            spamreader = csv.DictReader(lines(), fieldnames=fieldnames)
+            if offset == 0:
+                self.conn.execute("DELETE FROM documents")
+            while True:
+                chunk = [(row['document_id'], row['content']) for row in itertools.islice(spamreader, self.chunk_size)]
+                if not chunk:
+                    break
+                # CSVReader answers with the first matching row, so later duplicates are ignored
+                self.conn.executemany("INSERT OR IGNORE INTO documents (document_id, content) VALUES (?, ?)", chunk)
+                imported += len(chunk)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO import_state VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    self.file_name,
+                    end,
+                    stat.st_mtime_ns,
+                    end,
+                    self.fingerprint(end),
+                    ",".join(spamreader.fieldnames or [])
+                )
+            )
+        return imported
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+# csv_partitions.py
+import csv
+import glob
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional, Tuple
+
+from context import Deadline, DeadlineExceeded
+from database import BaseClient, CSVReader
+
+
+def index_csv_partition(file_name: str) -> Optional[Tuple[str, int, int, List[str]]]:
+    try:
+        stat = os.stat(file_name)
+        with open(file_name, newline='') as csv_file:
+            document_ids = [row['document_id'] for row in csv.DictReader(csv_file)]
+    except FileNotFoundError:
+        # Deleted since it was listed
+        return None
+    return file_name, stat.st_size, stat.st_mtime_ns, document_ids
+
+
+def scan_csv_partition(file_name: str, document_ids: List[str]) -> Dict[str, dict]:
+    return CSVReader(file_name).get_documents(document_ids)
+
+
+class Partition:
+    def __init__(self, file_name: str, size: int, mtime_ns: int, document_ids: List[str]):
+        self.file_name = file_name
+        self.size = size
+        self.mtime_ns = mtime_ns
+        # Kept to rebuild the locations when another part file changes; the tuple and
+        # the locations share the same string objects
+        self.document_ids = tuple(document_ids)
+        self.reader = CSVReader(file_name)
+
+
+class PartitionSet:
+    # Replaced as a whole on refresh, so readers never see a half-updated view
+    def __init__(self, partitions: Dict[str, Partition]):
+        self.by_file = partitions
+        self.locations: Dict[str, Partition] = {}
+        # Like a single CSVReader, the first part file holding an ID answers for it
+        for file_name in sorted(partitions, reverse=True):
+            partition = partitions[file_name]
+            self.locations.update(dict.fromkeys(partition.document_ids, partition))
+
+    def locate(self, document_id: str) -> Optional[Partition]:
+        return self.locations.get(document_id)
+
+
+class PartitionedCSVReader(BaseClient):
+    def __init__(
+        self,
+        path: str,
+        pattern: str = "*.csv",
+        processes: Optional[int] = None,
+        check_interval: float = 1.0
+    ):
+        # path is either a directory holding the part files or a glob
+        self.path = path
+        self.pattern = pattern
+        self.processes = processes
+        self.check_interval = check_interval
+        self.last_check = 0.0
+        self.state = PartitionSet({})
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.refresh()
+
+    def get_document(self, document_id: str, deadline: Optional[Deadline] = None) -> dict:
+        self.refresh_if_due()
+        partition = self.state.locate(document_id)
+        if partition is None:
+            return {}
+        return partition.reader.get_document(document_id, deadline)
+
+    def get_documents(self, document_ids: List[str], deadline: Optional[Deadline] = None) -> Dict[str, dict]:
+        self.refresh_if_due()
+        documents: Dict[str, dict] = {document_id: {} for document_id in document_ids}
+        state = self.state
+        groups: Dict[str, List[str]] = {}
+        for document_id in dict.fromkeys(document_ids):
+            partition = state.locate(document_id)
+            if partition is not None:
+                groups.setdefault(partition.file_name, []).append(document_id)
+        if len(groups) == 1:
+            file_name, group = groups.popitem()
+            documents.update(state.by_file[file_name].reader.get_documents(group, deadline))
+            return documents
+        if not groups:
+            return documents
+        pool = self.get_pool()
+        futures = [pool.submit(scan_csv_partition, file_name, group) for file_name, group in groups.items()]
+        try:
+            for future in futures:
+                documents.update(future.result(timeout=None if deadline is None else deadline.remaining()))
+        except FutureTimeoutError:
+            for future in futures:
+                future.cancel()
+            raise DeadlineExceeded("Deadline exceeded scanning the partitions")
+        return documents
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.processes)
+            return self.pool
+
+    def list_files(self) -> List[str]:
+        if os.path.isdir(self.path):
+            return sorted(glob.glob(os.path.join(self.path, self.pattern)))
+        return sorted(glob.glob(self.path))
+
+    def refresh_if_due(self) -> None:
+        if time.monotonic() - self.last_check < self.check_interval:
+            return
+        # Lookups keep using the current partitions while another request refreshes them
+        if not self.refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self.update_partitions()
+        finally:
+            self.refresh_lock.release()
+
+    def refresh(self) -> List[str]:
+        with self.refresh_lock:
+            return self.update_partitions()
+
+    def update_partitions(self) -> List[str]:
+        # Must be called with self.refresh_lock held
+        self.last_check = time.monotonic()
+        files = []
+        current = self.state.by_file
+        changed = []
+        for file_name in self.list_files():
+            partition = current.get(file_name)
+            try:
+                stat = os.stat(file_name)
+            except FileNotFoundError:
+                # Deleted between the glob and the stat, handled as removed
+                continue
+            files.append(file_name)
+            if partition is None or (partition.size, partition.mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                changed.append(file_name)
+        removed = sorted(current.keys() - set(files))
+        if not changed and not removed:
+            return []
+        if len(changed) == 1:
+            indexes = [index_csv_partition(changed[0])]
+        else:
+            indexes = list(self.get_pool().map(index_csv_partition, changed))
+        partitions = dict(current)
+        for file_name in removed:
+            del partitions[file_name]
+        for file_name, index in zip(changed, indexes):
+            if index is None:
+                partitions.pop(file_name, None)
+            else:
+                partitions[file_name] = Partition(*index)
+        self.state = PartitionSet(partitions)
+        return changed + removed
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+# profiling.py
+import cProfile
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+from context import Deadline, Trace, current_trace
+from database import BaseClient
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    def __init__(
+        self,
+        sample_rate: float = 0.01,
+        slow_threshold: Optional[float] = None,
+        max_records: int = 1000
+    ):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.traces: deque = deque(maxlen=max_records)
+        self.slow_lookups: deque = deque(maxlen=max_records)
+        self.capturing = False
+        self.profiles: List[cProfile.Profile] = []
+        self.skipped_profiles = 0
+        self.lock = threading.Lock()
+
+    def profile(self, func: Callable, *args) -> Any:
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not self.capturing:
+            return func(*args, sampled=sampled)
+        # cProfile only sees its own thread, so every request in the window gets its own profile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows a single active profiler, concurrent requests run unprofiled
+            with self.lock:
+                self.skipped_profiles += 1
+            return func(*args, sampled=sampled)
+        try:
+            return func(*args, sampled=sampled)
+        finally:
+            profile.disable()
+            with self.lock:
+                if self.capturing:
+                    self.profiles.append(profile)
+
+    def lookup(self, client: BaseClient, document_id: str, deadline: Optional[Deadline], sampled: bool) -> dict:
+        if not sampled and self.slow_threshold is None:
+            return client.get_document(document_id, deadline)
+        trace = Trace(document_id)
+        token = current_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            return client.get_document(document_id, deadline)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_trace.reset(token)
+            if sampled:
+                self.traces.append({
+                    "document_id": document_id,
+                    "elapsed": elapsed,
+                    "answered_by": trace.answered_by,
+                    "spans": trace.spans
+                })
+            if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+                self.slow_lookups.append({
+                    "document_id": document_id,
+                    "elapsed": elapsed,
+                    "answered_by": trace.answered_by
+                })
+                logger.warning(
+                    "Slow lookup of document %s: %.1f ms, answered by %s",
+                    document_id, elapsed * 1000, trace.answered_by
+                )
+
+    def tier_summary(self) -> Dict[str, Dict[str, float]]:
+        summary: Dict[str, Dict[str, float]] = {}
+        for trace in list(self.traces):
+            for tier, elapsed, found in trace["spans"]:
+                tier_stats = summary.setdefault(tier, {"calls": 0, "found": 0, "total_time": 0.0})
+                tier_stats["calls"] += 1
+                tier_stats["found"] += found
+                tier_stats["total_time"] += elapsed
+        return summary
+
+    def capture(self, duration: float, output_dir: str, trace_frames: int = 1) -> threading.Timer:
+        with self.lock:
+            if self.capturing:
+                raise RuntimeError("A profiling capture is already running")
+            self.capturing = True
+            self.profiles = []
+        tracemalloc.start(trace_frames)
+        timer = threading.Timer(duration, self.dump_capture, args=(output_dir,))
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def dump_capture(self, output_dir: str) -> Dict[str, str]:
+        with self.lock:
+            self.capturing = False
+            profiles, self.profiles = self.profiles, []
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        os.makedirs(output_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        paths = {}
+        if profiles:
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            paths["cpu"] = os.path.join(output_dir, f"cpu-{stamp}.pstats")
+            stats.dump_stats(paths["cpu"])
+        paths["memory"] = os.path.join(output_dir, f"memory-{stamp}.txt")
+        with open(paths["memory"], "w") as memory_file:
+            for statistic in snapshot.statistics("lineno")[:50]:
+                memory_file.write(f"{statistic}\n")
+        return paths
+
+
+# chain_router.py
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from context import Deadline, DeadlineExceeded
+from database import BaseClient
+
+ALL_IDS = "*"
+
+
+class TierStats:
+    __slots__ = ("attempts", "hits", "latency")
+
+    def __init__(self):
+        self.attempts = 0
+        self.hits = 0
+        self.latency = 0.0
+
+    def hit_probability(self) -> float:
+        # Laplace smoothing keeps unexplored tiers from scoring 0 or 1
+        return (self.hits + 1) / (self.attempts + 2)
+
+
+class ChainRouter(BaseClient):
+    def __init__(
+        self,
+        tiers: List[Tuple[str, BaseClient]],
+        prefix_length: Optional[int] = None,
+        bucket_fn: Optional[Callable[[str], str]] = None,
+        pinned_order: Optional[List[str]] = None,
+        min_samples: int = 20,
+        skip_below: float = 0.01,
+        exhaustive: bool = True,
+        explore_rate: float = 0.05,
+        decay: float = 0.2,
+        failure_penalty: float = 1.0
+    ):
+        self.tiers = dict(tiers)
+        if pinned_order is not None and set(pinned_order) - set(self.tiers):
+            raise ValueError(f"Unknown tiers in pinned order: {sorted(set(pinned_order) - set(self.tiers))}")
+        self.prefix_length = prefix_length
+        self.bucket_fn = bucket_fn
+        self.pinned_order = pinned_order
+        self.min_samples = min_samples
+        self.skip_below = skip_below
+        # When False, tiers that almost never hit for a bucket are not queried at all
+        self.exhaustive = exhaustive
+        self.explore_rate = explore_rate
+        self.decay = decay
+        # Latency charged to a tier that raised, so a broken tier sinks to the end of the plan
+        self.failure_penalty = failure_penalty
+        self.stats: Dict[str, Dict[str, TierStats]] = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, document_id: str) -> str:
+        if self.bucket_fn is not None:
+            return self.bucket_fn(document_id)
+        if self.prefix_length is not None:
+            return document_id[:self.prefix_length]
+        return ALL_IDS
+
+    def tier_stats(self, bucket: str, name: str) -> TierStats:
+        bucket_stats = self.stats.get(bucket, {}).get(name)
+        if bucket_stats is not None and bucket_stats.attempts >= self.min_samples:
+            return bucket_stats
+        # Not enough data for this bucket yet, fall back to what all ids have shown
+        return self.stats.get(ALL_IDS, {}).get(name) or bucket_stats or TierStats()
+
+    def plan(self, document_id: str) -> List[Dict[str, Any]]:
+        bucket = self.bucket(document_id)
+        with self.lock:
+            steps = []
+            for position, name in enumerate(self.pinned_order or self.tiers):
+                tier_stats = self.tier_stats(bucket, name)
+                hit_probability = tier_stats.hit_probability()
+                # Querying tiers by ascending cost / p(hit) minimises the expected cost of a lookup
+                score = max(tier_stats.latency, 1e-6) / hit_probability
+                skipped = (
+                    self.pinned_order is None
+                    and not self.exhaustive
+                    and tier_stats.attempts >= self.min_samples
+                    and hit_probability < self.skip_below
+                )
+                steps.append({
+                    "tier": name,
+                    "hit_probability": hit_probability,
+                    "latency": tier_stats.latency,
+                    "attempts": tier_stats.attempts,
+                    "score": score,
+                    "skipped": skipped,
+                    "position": position
+                })
+        if self.pinned_order is None:
+            steps.sort(key=lambda step: (step["score"], step["position"]))
+        return steps
+
+    def get_document(self, document_id: str, deadline: Optional[Deadline] = None) -> dict:
+        steps = self.plan(document_id)
+        if self.pinned_order is None and random.random() < self.explore_rate:
+            # Occasionally try another order so that stats for the later tiers keep updating
+            random.shuffle(steps)
+            order = [step["tier"] for step in steps]
+        else:
+            order = [step["tier"] for step in steps if not step["skipped"]]
+        bucket = self.bucket(document_id)
+        answered = False
+        error: Optional[Exception] = None
+        for name in order:
+            if deadline is not None:
+                deadline.check()
+            started = time.perf_counter()
+            try:
+                document = self.tiers[name].get_document(document_id, deadline)
+            except DeadlineExceeded:
+                # The caller's budget ran out, that says nothing about the tier
+                raise
+            except Exception as e:
+                self.record(bucket, name, max(time.perf_counter() - started, self.failure_penalty), False)
+                error = e
+                continue
+            self.record(bucket, name, time.perf_counter() - started, bool(document))
+            answered = True
+            if document:
+                return document
+        if not answered and error is not None:
+            raise ConnectionError(f"No tier could answer for document {document_id}: {repr(error)}")
+        return {}
+
+    def record(self, bucket: str, name: str, latency: float, found: bool) -> None:
+        with self.lock:
+            for key in {bucket, ALL_IDS}:
+                tier_stats = self.stats.setdefault(key, {}).setdefault(name, TierStats())
+                tier_stats.attempts += 1
+                tier_stats.hits += found
+                if tier_stats.attempts == 1:
+                    tier_stats.latency = latency
+                else:
+                    tier_stats.latency = (1 - self.decay) * tier_stats.latency + self.decay * latency
+
+    def explain(self, document_id: str) -> Dict[str, Any]:
+        return {
+            "bucket": self.bucket(document_id),
+            "pinned": self.pinned_order is not None,
+            "plan": self.plan(document_id)
+        }
+
+    def stats_snapshot(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        with self.lock:
+            return {
+                bucket: {
+                    name: {
+                        "attempts": tier_stats.attempts,
+                        "hits": tier_stats.hits,
+                        "hit_probability": tier_stats.hit_probability(),
+                        "latency": tier_stats.latency
+                    }
+                    for name, tier_stats in tiers.items()
+                }
+                for bucket, tiers in self.stats.items()
+            }
+
+
+# cliente.py
+from typing import Dict, List, Any, Optional, Tuple
+from context import Deadline, DeadlineExceeded, OK, NOT_FOUND, DEADLINE_EXCEEDED, ERROR
+from database import MongoClient, MySQLClient, CacheReader, BaseClient, CSVReader
+from chain_router import ChainRouter
+from resilience import AIMDLimiter, CircuitBreaker
+from sharding import CacheNode, ShardedCacheClient
+from csv_store import SQLiteCSVStore
+from csv_partitions import PartitionedCSVReader
+from profiling import Profiler
+
+
+class APP:
+    def __init__(self, client: BaseClient, profiler: Optional[Profiler] = None):
+        self.client = client
+        self.profiler = profiler
+    
+    def get_documents_from_ids(self, documents_id: List[str], deadline: Optional[Deadline] = None) -> dict:
+        if self.profiler is not None:
+            return self.profiler.profile(self.lookup_documents, documents_id, deadline)
+        return self.lookup_documents(documents_id, deadline)
+
+    def lookup_documents(
+        self,
+        documents_id: List[str],
+        deadline: Optional[Deadline] = None,
+        sampled: bool = False
+    ) -> dict:
+        products = {}
+        for document_id in documents_id:
+            products[document_id] = self.lookup(document_id, deadline, sampled)
+        return products
+
+    def lookup(self, document_id: str, deadline: Optional[Deadline] = None, sampled: bool = False) -> dict:
+        if self.profiler is None:
+            return self.client.get_document(document_id, deadline)
+        return self.profiler.lookup(self.client, document_id, deadline, sampled)
+
+    def get_documents_with_status(
+        self,
+        documents_id: List[str],
+        timeout: Optional[float] = None,
+        deadline: Optional[Deadline] = None
+    ) -> Tuple[dict, Dict[str, str]]:
+        if deadline is None:
+            deadline = Deadline(timeout)
+        products = {}
+        statuses = {}
+        for document_id in documents_id:
+            if deadline.expired():
+                statuses[document_id] = DEADLINE_EXCEEDED
+                continue
+            try:
+                document = self.lookup(document_id, deadline)
+            except DeadlineExceeded:
+                statuses[document_id] = DEADLINE_EXCEEDED
+                continue
+            except ConnectionError:
+                statuses[document_id] = ERROR
+                continue
+            products[document_id] = document
+            statuses[document_id] = OK if document else NOT_FOUND
+        return products, statuses
+
+    @classmethod
+    def create_app_chain_responsability(
+        cls,
+        use_cache: bool,
+        db_client_config: Dict[str, Any],
+        csv_reader_config: Dict[str, Any],
+        cache_config: Optional[Dict[str, Any]] = None,
+        cache_nodes: Optional[Dict[str, CacheNode]] = None,
+        breaker_config: Optional[Dict[str, Any]] = None,
+        limiter_config: Optional[Dict[str, Any]] = None
+    ) -> 'APP':
+        breaker = None
+        if breaker_config is not None:
+            limiter = AIMDLimiter(**limiter_config) if limiter_config is not None else None
+            breaker = CircuitBreaker(name="mongo", limiter=limiter, **breaker_config)
+        client = MongoClient(CSVReader(**csv_reader_config), breaker=breaker, **db_client_config)
+        if use_cache and cache_nodes:
+            return cls(ShardedCacheClient(client, cache_nodes))
+        if use_cache:
+            cache = CacheReader(client, **(cache_config or {}))
+            return cls(cache)
+        return cls(client)
+
+    @classmethod
+    def create_app_adaptive_chain(
+        cls,
+        use_cache: bool,
+        db_client_config: Dict[str, Any],
+        csv_reader_config: Dict[str, Any],
+        sql_client_config: Optional[Dict[str, Any]] = None,
+        router_config: Optional[Dict[str, Any]] = None,
+        cache_config: Optional[Dict[str, Any]] = None
+    ) -> 'APP':
+        tiers = [
+            ("mongo", MongoClient(None, **db_client_config)),
+            ("csv", CSVReader(**csv_reader_config))
+        ]
+        if sql_client_config is not None:
+            tiers.append(("mysql", MySQLClient(**sql_client_config)))
+        client = ChainRouter(tiers, **(router_config or {}))
+        if use_cache:
+            cache = CacheReader(client, **(cache_config or {}))
+            return cls(cache)
+        return cls(client)
+
+    @classmethod
+    def create_app_use_mongo(
+        cls,
+        use_cache: bool,
+        db_client_config: Dict[str, Any],
+        cache_config: Optional[Dict[str, Any]] = None,
+        cache_nodes: Optional[Dict[str, CacheNode]] = None
+    ) -> 'APP':
+        client = MongoClient(**db_client_config)
+        if use_cache and cache_nodes:
+            return cls(ShardedCacheClient(client, cache_nodes))
+        if use_cache:
+            cache = CacheReader(client, **(cache_config or {}))
+            return cls(cache)
+        return cls(client)
+
+    @classmethod
+    def create_app_use_csvreader(
+        cls,
+        use_cache: bool,
+        csv_reader_config: Dict[str, Any],
+        cache_config: Optional[Dict[str, Any]] = None,
+        cache_nodes: Optional[Dict[str, CacheNode]] = None
+    ) -> 'APP':
+        client = CSVReader(**csv_reader_config)
+        if use_cache and cache_nodes:
+            return cls(ShardedCacheClient(client, cache_nodes))
+        if use_cache:
+            cache = CacheReader(client, **(cache_config or {}))
+            return cls(cache)
+        return cls(client)
+
+    @classmethod
+    def create_app_use_csv_store(
+        cls,
+        use_cache: bool,
+        csv_store_config: Dict[str, Any],
+        cache_config: Optional[Dict[str, Any]] = None,
+        cache_nodes: Optional[Dict[str, CacheNode]] = None
+    ) -> 'APP':
+        client = SQLiteCSVStore(**csv_store_config)
+        if use_cache and cache_nodes:
+            return cls(ShardedCacheClient(client, cache_nodes))
+        if use_cache:
+            cache = CacheReader(client, **(cache_config or {}))
+            return cls(cache)
+        return cls(client)
+
+    @classmethod
+    def create_app_use_partitioned_csv(
+        cls,
+        use_cache: bool,
+        partitioned_csv_config: Dict[str, Any],
+        cache_config: Optional[Dict[str, Any]] = None,
+        cache_nodes: Optional[Dict[str, CacheNode]] = None
+    ) -> 'APP':
+        client = PartitionedCSVReader(**partitioned_csv_config)
+        if use_cache and cache_nodes:
+            return cls(ShardedCacheClient(client, cache_nodes))
+        if use_cache:
+            cache = CacheReader(client, **(cache_config or {}))
+            return cls(cache)
+        return cls(client)
+
+
+# Con Mongodb
+mongo_config = {....}
+mongo_client = MongoClient(**mongo_config)
+my_app = APP(mongo_client)
+# Con CSV
+csv_config = {....}
+csv_client = CSVReader(**csv_config)
+my_app = APP(csv_client)
+# Con MySQL
+sql_config = {....}
+sql_client = MySQLClient(**sql_config)
+my_app = APP(sql_client)
+
+
+# admission.py
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from cliente import APP
+from context import Deadline, DeadlineExceeded
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens: float, max_wait: float) -> Optional[float]:
+        # Takes the tokens now, possibly into debt, if they are refilled within max_wait.
+        # Returns the tokens that were available, None when the request does not fit.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if tokens > self.tokens and (self.rate <= 0 or (tokens - self.tokens) / self.rate > max_wait):
+                return None
+            available = self.tokens
+            self.tokens -= tokens
+            return available
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        app: APP,
+        max_concurrency: int = 8,
+        priorities: Tuple[str, ...] = ("interactive", "batch"),
+        queue_limits: Optional[Dict[str, int]] = None,
+        tenant_limits: Optional[Dict[str, Tuple[float, float]]] = None,
+        default_tenant_limit: Optional[Tuple[float, float]] = None,
+        batch_chunk_size: int = 50
+    ):
+        self.app = app
+        self.max_concurrency = max_concurrency
+        # Earlier entries are served first
+        self.priorities = priorities
+        self.queue_limits = {priority: 100 for priority in priorities}
+        self.queue_limits.update(queue_limits or {})
+        self.tenant_limits = tenant_limits or {}
+        self.default_tenant_limit = default_tenant_limit
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.batch_chunk_size = batch_chunk_size
+        self.queues: Dict[str, deque] = {priority: deque() for priority in priorities}
+        self.running = 0
+        self.service_time = 0.0
+        self.condition = threading.Condition()
+        self.stats: Dict[str, Dict[str, int]] = {
+            priority: {"admitted": 0, "rejected": 0, "rate_limited": 0, "timed_out": 0}
+            for priority in priorities
+        }
+
+    def get_documents_from_ids(
+        self,
+        documents_id: List[str],
+        priority: str = "interactive",
+        tenant: Optional[str] = None,
+        timeout: Optional[float] = None
+    ) -> dict:
+        if priority not in self.queues:
+            raise ValueError(f"Unknown priority: {priority}")
+        deadline = Deadline(timeout)
+        chunk_size = len(documents_id) or 1
+        if priority != self.priorities[0]:
+            # Lower priority work gives its slot back between chunks so interactive calls can cut in
+            chunk_size = self.batch_chunk_size
+        bucket = self.get_bucket(tenant)
+        if bucket is not None:
+            # The whole batch is charged before any work starts; what the bucket cannot cover
+            # yet is paced chunk by chunk, and only if it is refilled before the deadline
+            available = bucket.reserve(len(documents_id), deadline.remaining() or 0.0)
+            if available is None:
+                self.stats[priority]["rate_limited"] += 1
+                raise AdmissionRejected(f"Rate limit exceeded for tenant {tenant}")
+            reserved_at = time.monotonic()
+            chunk_size = min(chunk_size, max(1, int(bucket.burst)))
+        products = {}
+        for start in range(0, len(documents_id), chunk_size):
+            if bucket is not None:
+                charged = min(start + chunk_size, len(documents_id))
+                delay = reserved_at + (charged - available) / bucket.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self.acquire(priority, deadline)
+            started_at = time.perf_counter()
+            try:
+                products.update(self.app.get_documents_from_ids(documents_id[start:start + chunk_size], deadline))
+            finally:
+                self.release(time.perf_counter() - started_at)
+        return products
+
+    def get_bucket(self, tenant: Optional[str]) -> Optional[TokenBucket]:
+        if tenant is None:
+            return None
+        bucket = self.buckets.get(tenant)
+        if bucket is None:
+            limit = self.tenant_limits.get(tenant, self.default_tenant_limit)
+            if limit is None:
+                return None
+            bucket = self.buckets.setdefault(tenant, TokenBucket(*limit))
+        return bucket
+
+    def next_ticket(self) -> Optional[object]:
+        for priority in self.priorities:
+            if self.queues[priority]:
+                return self.queues[priority][0]
+        return None
+
+    def acquire(self, priority: str, deadline: Deadline) -> None:
+        with self.condition:
+            queue = self.queues[priority]
+            if self.running < self.max_concurrency and self.next_ticket() is None:
+                self.running += 1
+                self.stats[priority]["admitted"] += 1
+                return
+            if len(queue) >= self.queue_limits[priority]:
+                self.stats[priority]["rejected"] += 1
+                raise AdmissionRejected(f"Queue for {priority} requests is full")
+            ahead = sum(len(self.queues[other]) for other in self.priorities[:self.priorities.index(priority) + 1])
+            expected_wait = (ahead + 1) * self.service_time / self.max_concurrency
+            remaining = deadline.remaining()
+            if remaining is not None and expected_wait > remaining:
+                # Shed now instead of queueing work that would miss its deadline anyway
+                self.stats[priority]["rejected"] += 1
+                raise AdmissionRejected(f"Expected queueing time {expected_wait:.3f}s exceeds the deadline")
+            ticket = object()
+            queue.append(ticket)
+            while self.running >= self.max_concurrency or self.next_ticket() is not ticket:
+                remaining = deadline.remaining()
+                if remaining == 0.0:
+                    queue.remove(ticket)
+                    self.condition.notify_all()
+                    self.stats[priority]["timed_out"] += 1
+                    raise DeadlineExceeded(f"Deadline exceeded waiting in the {priority} queue")
+                self.condition.wait(remaining)
+            queue.popleft()
+            self.running += 1
+            self.stats[priority]["admitted"] += 1
+
+    def release(self, elapsed: float) -> None:
+        with self.condition:
+            self.running -= 1
+            self.service_time = 0.8 * self.service_time + 0.2 * elapsed if self.service_time else elapsed
+            self.condition.notify_all()
+
+
+# loadgen.py
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from cliente import APP
+
+MODES = ("closed", "fixed", "open")
+
+
+def load_trace(path: str) -> Tuple[List[str], Optional[List[float]]]:
+    # One document id per line, or "timestamp,document_id" to replay the recorded pacing
+    ids: List[str] = []
+    timestamps: List[float] = []
+    with open(path) as trace_file:
+        for line in trace_file:
+            line = line.strip()
+            if not line:
+                continue
+            if "," in line:
+                timestamp, document_id = line.split(",", 1)
+                timestamps.append(float(timestamp))
+            else:
+                document_id = line
+            ids.append(document_id)
+    if timestamps and len(timestamps) != len(ids):
+        raise ValueError(f"Trace {path} mixes timestamped and plain lines")
+    if not timestamps:
+        return ids, None
+    first = timestamps[0]
+    return ids, [timestamp - first for timestamp in timestamps]
+
+
+def zipf_trace(num_ids: int, num_requests: int, exponent: float = 1.1, seed: Optional[int] = None) -> List[str]:
+    rng = random.Random(seed)
+    weights = [1 / rank ** exponent for rank in range(1, num_ids + 1)]
+    return [str(rank) for rank in rng.choices(range(1, num_ids + 1), weights=weights, k=num_requests)]
+
+
+def build_app(config: Dict[str, Any]) -> APP:
+    factory = config["factory"]
+    if not factory.startswith("create_app_") or not hasattr(APP, factory):
+        raise ValueError(f"Unknown APP factory: {factory}")
+    return getattr(APP, factory)(**config.get("kwargs", {}))
+
+
+def rss_kb() -> Tuple[str, int]:
+    # Current resident set size where /proc is available, the peak otherwise
+    try:
+        with open("/proc/self/statm") as statm:
+            return "rss_kb", int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return "max_rss_kb", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        app: APP,
+        ids: List[str],
+        mode: str = "closed",
+        concurrency: int = 8,
+        rate: float = 100.0,
+        timestamps: Optional[List[float]] = None,
+        batch_size: int = 1,
+        report_interval: float = 1.0
+    ):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode: {mode}")
+        self.app = app
+        self.batches = [ids[start:start + batch_size] for start in range(0, len(ids), batch_size)]
+        self.mode = mode
+        self.concurrency = concurrency
+        self.rate = rate
+        self.timestamps = timestamps[::batch_size] if timestamps else None
+        self.report_interval = report_interval
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.timeline: List[Dict[str, Any]] = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def request(self, batch: List[str], scheduled_at: float) -> None:
+        try:
+            self.app.get_documents_from_ids(batch)
+            failed = False
+        except Exception:
+            failed = True
+        # Measured from the scheduled send time so a backed-up client doesn't hide queueing delay
+        latency = time.perf_counter() - scheduled_at
+        with self.lock:
+            self.latencies.append(latency)
+            self.errors += failed
+
+    def run(self) -> Dict[str, Any]:
+        sampler = threading.Thread(target=self.sample, daemon=True)
+        self.started_at = time.perf_counter()
+        sampler.start()
+        if self.mode == "closed":
+            self.run_closed()
+        else:
+            self.run_scheduled()
+        duration = time.perf_counter() - self.started_at
+        self.done.set()
+        sampler.join()
+        return self.report(duration)
+
+    def run_closed(self) -> None:
+        batches = iter(self.batches)
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    batch = next(batches, None)
+                if batch is None:
+                    return
+                self.request(batch, time.perf_counter())
+
+        workers = [threading.Thread(target=worker) for _ in range(self.concurrency)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+    def run_scheduled(self) -> None:
+        rng = random.Random()
+        offset = 0.0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for index, batch in enumerate(self.batches):
+                if self.timestamps is not None:
+                    offset = self.timestamps[index]
+                elif self.mode == "fixed":
+                    offset = index / self.rate
+                else:
+                    offset += rng.expovariate(self.rate)
+                scheduled_at = self.started_at + offset
+                delay = scheduled_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self.request, batch, scheduled_at)
+
+    def sample(self) -> None:
+        while not self.done.wait(self.report_interval):
+            self.timeline.append(self.snapshot())
+        self.timeline.append(self.snapshot())
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            completed = len(self.latencies)
+        name, rss = rss_kb()
+        point = {
+            "elapsed": time.perf_counter() - self.started_at,
+            "completed": completed,
+            name: rss
+        }
+        memory_usage = getattr(self.app.client, "memory_usage", None)
+        if memory_usage is not None:
+            usage = memory_usage()
+            point["cache_entries"] = usage["entries"]
+            # Only caches with compression or a byte budget account for sizes
+            if usage["sized"]:
+                point["cache_bytes"] = usage["stored_bytes"]
+        return point
+
+    def report(self, duration: float) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+        report: Dict[str, Any] = {
+            "mode": self.mode,
+            "requests": len(latencies),
+            "errors": self.errors,
+            "duration": duration,
+            "throughput": len(latencies) / duration if duration else 0.0,
+            "latency": {
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "p999": percentile(latencies, 99.9),
+                "max": latencies[-1] if latencies else 0.0
+            },
+            "timeline": self.timeline
+        }
+        stats = getattr(self.app.client, "stats", None)
+        if isinstance(stats, dict) and "hits" in stats and "misses" in stats:
+            lookups = stats["hits"] + stats["misses"] + stats.get("stale_hits", 0)
+            report["cache"] = dict(stats)
+            report["cache"]["hit_rate"] = (lookups - stats["misses"]) / lookups if lookups else 0.0
+        return report
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Replay document id traces against an APP")
+    parser.add_argument("config", help="JSON file with the APP factory name and its kwargs")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--trace", help="Recorded id access log to replay")
+    source.add_argument("--zipf", type=int, metavar="NUM_IDS", help="Generate a Zipf distributed trace")
+    parser.add_argument("--requests", type=int, default=10000, help="Lookups to generate with --zipf")
+    parser.add_argument("--zipf-exponent", type=float, default=1.1)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--mode", choices=MODES, default="closed")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=100.0, help="Requests per second in fixed and open modes")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--report-interval", type=float, default=1.0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    with open(args.config) as config_file:
+        app = build_app(json.load(config_file))
+    timestamps = None
+    if args.trace:
+        ids, timestamps = load_trace(args.trace)
+    else:
+        ids = zipf_trace(args.zipf, args.requests, args.zipf_exponent, args.seed)
+    generator = LoadGenerator(
+        app,
+        ids,
+        mode=args.mode,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        timestamps=timestamps if args.mode == "open" else None,
+        batch_size=args.batch_size,
+        report_interval=args.report_interval
+    )
+    report = json.dumps(generator.run(), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report)
+    else:
+        sys.stdout.write(report + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# tests.py
+import asyncio
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from unittest import mock
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+from batching import MicroBatcher
+from chain_router import ALL_IDS, ChainRouter
+from cliente import APP
+from context import OK, NOT_FOUND, DEADLINE_EXCEEDED, Deadline, DeadlineExceeded
+from database import (
+    BaseClient, CSVChangeFeed, CSVReader, CacheReader, LocalChangeFeed, MongoClient, MySQLChangeFeed, MySQLClient,
+    StoredValue
+)
+from loadgen import load_trace, main
+from profiling import Profiler
+from replicas import ReplicaRouter
+from resilience import AIMDLimiter, CircuitBreaker, CircuitOpenError
+from sharding import LocalCacheNode, ProcessCacheNode, ShardedCacheClient
+from snapshots import SnapshotIndex, SnapshotMismatch, config_fingerprint
+from csv_store import SQLiteCSVStore
+
+
+class FakeClient(BaseClient):
+    def __init__(self, documents: Dict[str, Any]):
+        self.documents = documents
+        self.calls: List[str] = []
+
+    def get_document(self, document_id: str, deadline: Optional[Deadline] = None) -> dict:
+        self.calls.append(document_id)
+        return self.documents.get(document_id, {})
+
+
+def test_cache_evicts_changed_documents():
+    client = FakeClient({"1": {"v": 1}, "2": {"v": 1}})
+    feed = LocalChangeFeed()
+    cache = CacheReader(client, change_feed=feed, sync_interval=0)
+    cache.get_document("1")
+    cache.get_document("2")
+    client.documents["1"] = {"v": 2}
+    feed.publish("1", version=2)
+
+    assert cache.get_document("1") == {"v": 2}
+    assert cache.get_document("2") == {"v": 1}
+    assert client.calls == ["1", "2", "1"]
+
+
+def test_cache_ignores_already_seen_versions():
+    client = FakeClient({"1": {"v": 1}})
+    feed = LocalChangeFeed()
+    cache = CacheReader(client, change_feed=feed, refresh_on_change=True, sync_interval=0)
+    cache.get_document("1")
+    feed.publish("1", version=2)
+    assert cache.sync_changes() == ["1"]
+    feed.publish("1", version=2)
+    assert cache.sync_changes() == []
+    cache.executor.shutdown(wait=True)
+    assert client.calls == ["1", "1"]
+    assert cache.get_document("1") == {"v": 1}
+
+
+def test_cache_keeps_serving_hits_when_feed_fails():
+    client = FakeClient({"1": {"v": 1}})
+    feed = mock.Mock()
+    feed.poll.side_effect = ConnectionError("feed down")
+    cache = CacheReader(client, change_feed=feed, sync_interval=0)
+
+    assert cache.get_document("1") == {"v": 1}
+    assert cache.get_document("1") == {"v": 1}
+    assert cache.stats["feed_errors"] == 2
+    assert client.calls == ["1"]
+
+
+def test_cache_drops_versions_of_evicted_documents():
+    client = FakeClient({"1": {"v": 1}})
+    feed = LocalChangeFeed()
+    cache = CacheReader(client, change_feed=feed, sync_interval=0, refresh_on_change=True)
+    cache.get_document("1")
+    feed.publish("1", version=2)
+    cache.sync_changes()
+    cache.executor.shutdown(wait=True)
+    assert cache.versions == {"1": 2}
+    with cache.lock:
+        cache.forget("1")
+    assert cache.versions == {}
+
+
+def test_csv_change_feed_diffs_rows(tmp_path):
+    csv_file = tmp_path / "documents.csv"
+    csv_file.write_text("document_id,content\n1,a\n2,b\n")
+    feed = CSVChangeFeed(str(csv_file))
+    assert feed.poll() == {}
+    csv_file.write_text("document_id,content\n1,a\n2,c\n3,d\n")
+    os.utime(csv_file, ns=(0, os.stat(csv_file).st_mtime_ns + 1))
+
+    changes = feed.poll()
+    assert sorted(changes) == ["2", "3"]
+
+
+class SlowClient(FakeClient):
+    def __init__(self, documents: Dict[str, Any], delay: float):
+        super().__init__(documents)
+        self.delay = delay
+
+    def get_document(self, document_id: str, deadline: Optional[Deadline] = None) -> dict:
+        time.sleep(self.delay)
+        return super().get_document(document_id, deadline)
+
+
+def test_cache_serves_stale_while_revalidating():
+    client = SlowClient({"1": {"v": 1}}, delay=0.05)
+    cache = CacheReader(client, ttl=0.01, stale_while_revalidate=True)
+    cache.get_document("1")
+    time.sleep(0.02)
+    client.documents["1"] = {"v": 2}
+
+    assert cache.get_document("1") == {"v": 1}
+    assert cache.get_document("1") == {"v": 1}
+    cache.executor.shutdown(wait=True)
+    assert cache.get_document("1") == {"v": 2}
+    assert client.calls == ["1", "1"]
+    assert cache.metrics()["stale_hits"] == 2
+
+
+def test_cache_refreshes_hot_keys_ahead_of_expiry():
+    client = FakeClient({"1": {"v": 1}})
+    cache = CacheReader(client, ttl=0.05, refresh_ahead=0.5, refresh_ahead_min_hits=2)
+    cache.get_document("1")
+    time.sleep(0.03)
+    cache.get_document("1")
+    cache.get_document("1")
+    cache.executor.shutdown(wait=True)
+
+    assert client.calls == ["1", "1"]
+    assert cache.stats["refresh_ahead"] == 1
+    assert cache.stats["misses"] == 1
+
+
+class BulkClient(FakeClient):
+    def __init__(self, documents: Dict[str, Any]):
+        super().__init__(documents)
+        self.batches: List[List[str]] = []
+
+    def get_documents(self, document_ids: List[str], deadline: Optional[Deadline] = None) -> Dict[str, dict]:
+        self.batches.append(document_ids)
+        time.sleep(0.002)
+        return {document_id: self.documents.get(document_id, {}) for document_id in document_ids}
+
+
+def test_micro_batcher_groups_concurrent_lookups():
+    client = BulkClient({str(i): {"v": i} for i in range(50)})
+    batcher = MicroBatcher(client, max_batch_size=16, max_wait=0.01)
+    with ThreadPoolExecutor(max_workers=50) as pool:
+        results = list(pool.map(batcher.get_document, [str(i) for i in range(50)]))
+    batcher.close()
+
+    assert results == [{"v": i} for i in range(50)]
+    assert len(client.batches) < 50
+    assert all(len(batch) <= 16 for batch in client.batches)
+
+
+def test_micro_batcher_batches_bulk_lookups():
+    client = BulkClient({str(i): {"v": i} for i in range(20)})
+    batcher = MicroBatcher(client, max_batch_size=16, max_wait=0.01)
+    documents = batcher.get_documents([str(i) for i in range(20)] + ["1"])
+    batcher.close()
+
+    assert documents == {str(i): {"v": i} for i in range(20)}
+    assert len(client.batches) <= 3
+
+
+def test_micro_batcher_serves_coroutines():
+    client = BulkClient({"1": {"v": 1}, "2": {"v": 2}})
+    batcher = MicroBatcher(client, max_wait=0.01)
+
+    async def lookup():
+        return await asyncio.gather(batcher.aget_document("1"), batcher.aget_document("2"))
+
+    assert asyncio.run(lookup()) == [{"v": 1}, {"v": 2}]
+    batcher.close()
+    assert client.batches == [["1", "2"]]
+
+
+def test_breaker_opens_and_routes_to_next_tier():
+    next_resp = FakeClient({"1": {"1": "from csv"}})
+    breaker = CircuitBreaker(name="mongo", min_calls=2, window_size=2, reset_timeout=60)
+    client = MongoClient(next_resp, breaker=breaker)
+    client.coll = mock.Mock()
+    client.coll.find_one.side_effect = TimeoutError("mongo is slow")
+    for _ in range(2):
+        with pytest.raises(TimeoutError):
+            client.get_document("1")
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert client.get_document("1") == {"1": "from csv"}
+    assert client.coll.find_one.call_count == 2
+
+
+def test_breaker_ignores_calls_that_ran_out_of_caller_budget():
+    limiter = AIMDLimiter(initial_limit=4)
+    breaker = CircuitBreaker(name="mysql", min_calls=2, window_size=2, reset_timeout=60, limiter=limiter)
+    for _ in range(2):
+        with pytest.raises(DeadlineExceeded):
+            breaker.call(mock.Mock(side_effect=DeadlineExceeded("Query interrupted")))
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert len(breaker.outcomes) == 0
+    assert (limiter.limit, limiter.in_flight) == (4, 0)
+
+
+def test_breaker_closes_after_successful_trials():
+    breaker = CircuitBreaker(min_calls=1, window_size=1, reset_timeout=0, half_open_calls=2)
+    with pytest.raises(ValueError):
+        breaker.call(mock.Mock(side_effect=ValueError()))
+    assert breaker.state == CircuitBreaker.OPEN
+    breaker.call(lambda: None)
+    breaker.call(lambda: None)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_half_open_survives_limiter_rejections():
+    limiter = AIMDLimiter(initial_limit=1)
+    breaker = CircuitBreaker(min_calls=1, window_size=1, reset_timeout=0.05, half_open_calls=1, limiter=limiter)
+    with pytest.raises(ValueError):
+        breaker.call(mock.Mock(side_effect=ValueError()))
+    time.sleep(0.06)
+    limiter.in_flight = 1
+    with pytest.raises(CircuitOpenError, match="Concurrency limit"):
+        breaker.call(lambda: None)
+    limiter.in_flight = 0
+
+    breaker.call(lambda: None)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_reopens_when_half_open_trials_never_finish():
+    breaker = CircuitBreaker(min_calls=1, window_size=1, reset_timeout=0.05, half_open_calls=1)
+    with pytest.raises(ValueError):
+        breaker.call(mock.Mock(side_effect=ValueError()))
+    time.sleep(0.06)
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    time.sleep(0.06)
+    with pytest.raises(CircuitOpenError, match="is open"):
+        breaker.call(lambda: None)
+    time.sleep(0.06)
+    breaker.call(lambda: None)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_aimd_limiter_backs_off_on_slow_calls():
+    limiter = AIMDLimiter(initial_limit=4, latency_target=0.1)
+    assert all(limiter.acquire() for _ in range(4))
+    assert not limiter.acquire()
+    limiter.release(latency=0.5, failed=False)
+    assert limiter.limit == 2
+    limiter.release(latency=0.01, failed=False)
+    assert limiter.limit == 2.5
+
+
+def test_aimd_limiter_backs_off_once_per_round_trip():
+    limiter = AIMDLimiter(initial_limit=20, latency_target=0.01)
+    assert all(limiter.acquire() for _ in range(20))
+    time.sleep(0.02)
+    for _ in range(20):
+        limiter.release(latency=0.02, failed=False)
+    assert limiter.limit == 10
+
+
+def test_cache_skips_refresh_ahead_without_ttl():
+    cache = CacheReader(FakeClient({"1": {"v": 1}}), refresh_ahead=0.5, refresh_ahead_min_hits=0)
+    cache.get_document("1")
+    # Entries restored from a snapshot can carry an expiry even without a ttl
+    cache.expires["1"] = time.monotonic() + 60
+
+    assert cache.get_document("1") == {"v": 1}
+    assert cache.stats["refresh_ahead"] == 0
+
+
+def test_cache_serves_stale_entry_when_backend_is_down():
+    client = FakeClient({"1": {"v": 1}})
+    cache = CacheReader(client, ttl=0.01)
+    cache.get_document("1")
+    time.sleep(0.02)
+    client.get_document = mock.Mock(side_effect=CircuitOpenError("open"))
+
+    assert cache.get_document("1") == {"v": 1}
+    assert cache.stats["stale_hits"] == 1
+
+
+@pytest.mark.parametrize(["compression"], [("zlib",), ("lzma",), ("pickle",)])
+def test_cache_stores_compressed_documents(compression):
+    content = "lorem ipsum " * 1000
+    client = FakeClient({"1": {"1": content}, "2": {"2": "short"}})
+    cache = CacheReader(client, compression=compression, compress_threshold=256)
+    cache.get_document("1")
+    cache.get_document("2")
+
+    assert cache.get_document("1") == {"1": content}
+    assert cache.get_document("2") == {"2": "short"}
+    assert cache.cache["2"].codec == "pickle"
+    usage = cache.memory_usage()
+    if compression == "pickle":
+        assert usage["stored_bytes"] == usage["raw_bytes"]
+    else:
+        assert cache.cache["1"].codec == compression
+        assert usage["stored_bytes"] < usage["raw_bytes"] / 10
+
+
+def test_cache_evicts_least_recently_used_over_budget():
+    client = FakeClient({str(i): {str(i): "x" * 1000} for i in range(3)})
+    cache = CacheReader(client, max_bytes=2500)
+    cache.get_document("0")
+    cache.get_document("1")
+    cache.get_document("0")
+    cache.get_document("2")
+
+    assert list(cache.cache) == ["0", "2"]
+    assert cache.stats["evictions"] == 1
+    assert cache.memory_usage()["stored_bytes"] <= 2500
+
+
+def test_sharded_cache_moves_few_keys_when_a_node_joins():
+    client = FakeClient({str(i): {"v": i} for i in range(1000)})
+    cache = ShardedCacheClient(client, {"a": LocalCacheNode(), "b": LocalCacheNode(), "c": LocalCacheNode()})
+    for i in range(1000):
+        cache.get_document(str(i))
+
+    moved = cache.add_node("d", LocalCacheNode())
+    assert 100 < moved < 450
+    for i in range(1000):
+        assert cache.get_document(str(i)) == {"v": i}
+    assert cache.stats["misses"] == 1000
+
+    cache.remove_node("a")
+    assert cache.get_document("1") == {"v": 1}
+    assert cache.stats["misses"] == 1000
+
+
+def test_sharded_cache_serves_reads_while_nodes_join_and_leave():
+    client = FakeClient({str(i): {"v": i} for i in range(200)})
+    cache = ShardedCacheClient(client, {"a": LocalCacheNode(), "b": LocalCacheNode()}, vnodes=20)
+    stopped = threading.Event()
+
+    def read():
+        while not stopped.is_set():
+            for i in range(200):
+                assert cache.get_document(str(i)) == {"v": i}
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        readers = [pool.submit(read) for _ in range(2)]
+        for _ in range(20):
+            cache.add_node("c", LocalCacheNode())
+            cache.remove_node("c")
+        stopped.set()
+        for reader in readers:
+            reader.result()
+
+
+def test_sharded_cache_with_process_nodes():
+    nodes = {"a": ProcessCacheNode(), "b": ProcessCacheNode()}
+    try:
+        app = APP.create_app_use_csvreader(
+            use_cache=True,
+            csv_reader_config={"file_name": "unused.csv"},
+            cache_nodes=nodes
+        )
+        app.client.client = FakeClient({"1": {"v": 1}, "2": {"v": 2}})
+        assert app.get_documents_from_ids(["1", "2", "1"]) == {"1": {"v": 1}, "2": {"v": 2}}
+        assert sorted(nodes["a"].keys() + nodes["b"].keys()) == ["1", "2"]
+        assert app.client.stats == {"hits": 1, "misses": 2, "moved": 0}
+    finally:
+        for node in nodes.values():
+            node.close()
+
+
+def test_csv_store_imports_appended_rows_incrementally(tmp_path):
+    csv_file = tmp_path / "documents.csv"
+    csv_file.write_text("document_id,content\n1,a\n2,b\n2,duplicate\n")
+    store = SQLiteCSVStore(str(csv_file), db_path=str(tmp_path / "documents.db"), chunk_size=2)
+
+    assert store.refresh() == 0
+    assert store.get_document("2") == {"2": "b"}
+    assert store.get_document("9") == {}
+    with open(csv_file, "a") as csv_append:
+        csv_append.write("3,c\n")
+    assert store.refresh() == 1
+    assert store.get_documents(["1", "3", "9"]) == {"1": {"1": "a"}, "3": {"3": "c"}, "9": {}}
+    assert store.refresh() == 0
+
+
+def test_csv_store_waits_for_partially_written_rows(tmp_path):
+    csv_file = tmp_path / "documents.csv"
+    csv_file.write_text("document_id,content\n1,a\n2,b")
+    store = SQLiteCSVStore(str(csv_file))
+    assert store.get_documents(["1", "2"]) == {"1": {"1": "a"}, "2": {}}
+
+    with open(csv_file, "a") as csv_append:
+        csv_append.write("c\n3,d\n")
+    assert store.refresh() == 2
+    assert store.get_documents(["2", "3"]) == {"2": {"2": "bc"}, "3": {"3": "d"}}
+
+
+def test_csv_store_reimports_rewritten_file(tmp_path):
+    csv_file = tmp_path / "documents.csv"
+    csv_file.write_text("document_id,content\n1,a\n2,b\n")
+    app = APP.create_app_use_csv_store(use_cache=False, csv_store_config={"file_name": str(csv_file)})
+    assert app.get_documents_from_ids(["1"]) == {"1": {"1": "a"}}
+
+    csv_file.write_text("document_id,content\n1,z\n")
+    assert app.client.refresh() == 1
+    assert app.get_documents_from_ids(["1", "2"]) == {"1": {"1": "z"}, "2": {}}
+
+
+def test_csv_store_reimports_edits_inside_imported_rows(tmp_path):
+    csv_file = tmp_path / "documents.csv"
+    rows = "".join(f"{i},{'a' * 50}\n" for i in range(2000))
+    csv_file.write_text("document_id,content\n" + rows)
+    store = SQLiteCSVStore(str(csv_file))
+    stat = os.stat(csv_file)
+
+    # Same size, edited far from both ends of the file
+    csv_file.write_text("document_id,content\n" + rows.replace(f"1000,{'a' * 50}", f"1000,{'b' * 50}"))
+    os.utime(csv_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert store.refresh() == 2000
+    assert store.get_document("1000") == {"1000": "b" * 50}
+
+    with open(csv_file, "r+") as csv_edit:
+        csv_edit.seek(len("document_id,content\n") + 10)
+        csv_edit.write("c")
+    with open(csv_file, "a") as csv_append:
+        csv_append.write("2000,new\n")
+    assert store.refresh() == 2001
+    assert store.get_document("2000") == {"2000": "new"}
+
+
+class FakeReplica:
+    def __init__(self, delay: float, healthy: bool = True):
+        self.delay = delay
+        self.healthy = healthy
+        self.calls = 0
+
+    def find_one(self, query: dict, max_time_ms: Optional[int] = None) -> dict:
+        self.calls += 1
+        time.sleep(self.delay)
+        return {"_id": query["_id"]}
+
+
+def fake_ping(replica: FakeReplica) -> None:
+    if not replica.healthy:
+        raise ConnectionError("replica is down")
+
+
+def test_router_spreads_reads_and_ejects_slow_replica():
+    fast, other, slow = FakeReplica(0.001), FakeReplica(0.001), FakeReplica(0.03)
+    router = ReplicaRouter([fast, other, slow], eject_time=60, min_samples=1)
+    client = MongoClient(FakeClient({}), router=router)
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        list(pool.map(client.get_document, [str(i) for i in range(60)]))
+
+    assert fast.calls > 10 and other.calls > 10
+    assert slow.calls < 10
+    assert [replica["ejected"] for replica in router.stats()] == [False, False, False, True]
+
+
+def test_router_ejects_slow_replica_out_of_two():
+    router = ReplicaRouter([FakeReplica(0), FakeReplica(0)], eject_time=60, min_samples=3)
+    fast, slow = router.replicas
+    router.record(fast, 0.001, failed=False)
+    router.record(slow, 0.02, failed=False)
+    # A single slow call is not enough
+    assert not slow.ejected_until
+
+    for _ in range(2):
+        router.record(fast, 0.001, failed=False)
+        router.record(slow, 0.02, failed=False)
+    assert [replica["ejected"] for replica in router.stats()] == [False, False, True]
+
+
+def test_router_keeps_replicas_within_the_absolute_slack():
+    router = ReplicaRouter([FakeReplica(0), FakeReplica(0), FakeReplica(0)], min_samples=1)
+    for replica, latency in zip(router.replicas, [0.0002, 0.0002, 0.001]):
+        router.record(replica, latency, failed=False)
+
+    assert not any(replica["ejected"] for replica in router.stats())
+
+
+def test_router_falls_back_to_primary_when_replicas_are_unhealthy():
+    primary = FakeReplica(0)
+    replica = FakeReplica(0, healthy=False)
+    router = ReplicaRouter([replica], health_check=fake_ping)
+    router.check_health()
+    client = MongoClient(FakeClient({}), router=router)
+    client.coll = primary
+
+    assert client.get_document("1") == {"_id": "1"}
+    assert (primary.calls, replica.calls) == (1, 0)
+
+
+def mysql_client_returning(rows: List[tuple], **kwargs) -> MySQLClient:
+    client = MySQLClient(**kwargs)
+    client.select_table("documents")
+    cursor = mock.MagicMock()
+    cursor.description = [("document_id",), ("content",)]
+    batches = [rows[start:start + 2] for start in range(0, len(rows), 2)]
+    cursor.fetchmany.side_effect = batches + [[]]
+    conn = mock.MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cursor
+    client.connect = mock.MagicMock()
+    client.connect.return_value.__enter__.return_value = conn
+    return client
+
+
+def test_mysql_change_feed_emits_rows_at_the_watermark_once():
+    client = mysql_client_returning([])
+    cursor = client.connect.return_value.__enter__.return_value.cursor.return_value.__enter__.return_value
+    cursor.fetchone.return_value = (10,)
+    cursor.__iter__.side_effect = [
+        iter([("1",)]),
+        iter([("1", 10), ("2", 10)]),
+        iter([("1", 10), ("2", 10)]),
+        iter([("1", 10), ("2", 10), ("2", 11)])
+    ]
+    feed = MySQLChangeFeed(client)
+
+    assert feed.poll() == {}
+    assert feed.poll() == {"2": 10}
+    assert feed.poll() == {}
+    assert feed.poll() == {"2": 11}
+
+
+def test_mysql_client_maps_rows_to_named_tuples():
+    client = mysql_client_returning([("1", "a")])
+    document = client.get_document("1")
+
+    assert document["1"].content == "a"
+    assert document["1"] == ("1", "a")
+    assert client.row_type([("document_id",), ("content",)]) is type(document["1"])
+
+
+def test_mysql_client_returns_every_row_of_multi_row_documents():
+    client = mysql_client_returning([("1", "a"), ("2", "b"), ("1", "c")], multi_row=True)
+    documents = client.get_documents(["1", "2", "3"])
+
+    assert [row.content for row in documents["1"]["1"]] == ["a", "c"]
+    assert [row.content for row in documents["2"]["2"]] == ["b"]
+    assert documents["3"] == {}
+
+
+def test_app_returns_partial_results_when_deadline_runs_out():
+    client = SlowClient({"1": {"v": 1}, "2": {"v": 2}, "3": {"v": 3}}, delay=0.05)
+    app = APP(CacheReader(client))
+    documents, statuses = app.get_documents_with_status(["1", "2", "3"], timeout=0.08)
+
+    assert documents == {"1": {"v": 1}, "2": {"v": 2}}
+    assert statuses == {"1": OK, "2": OK, "3": DEADLINE_EXCEEDED}
+    assert client.calls == ["1", "2"]
+    documents, statuses = app.get_documents_with_status(["1", "4"])
+    assert statuses == {"1": OK, "4": NOT_FOUND}
+
+
+def test_chain_stops_csv_scan_when_deadline_is_cancelled(tmp_path):
+    csv_file = tmp_path / "documents.csv"
+    csv_file.write_text("document_id,content\n" + "".join(f"{i},c{i}\n" for i in range(5000)))
+    client = MongoClient(CSVReader(str(csv_file), check_every=100))
+    client.coll = mock.Mock()
+    client.coll.find_one.return_value = None
+    deadline = Deadline(timeout=10)
+
+    assert client.get_document("4999", deadline) == {"4999": "c4999"}
+    deadline.cancel()
+    with pytest.raises(DeadlineExceeded):
+        client.get_document("4999", deadline)
+    assert client.coll.find_one.call_count == 1
+
+
+def test_micro_batcher_drops_lookups_past_their_deadline():
+    client = BulkClient({"1": {"v": 1}})
+    batcher = MicroBatcher(client, max_wait=0.05)
+    batcher.wait = 0.05
+    with pytest.raises(DeadlineExceeded):
+        batcher.get_document("1", Deadline(timeout=0.001))
+    batcher.close()
+    assert client.batches == []
+
+
+def test_admission_rate_limits_tenants():
+    admission = AdmissionController(APP(FakeClient({})), tenant_limits={"acme": (1, 3)})
+    admission.get_documents_from_ids(["1", "2"], tenant="acme")
+    with pytest.raises(AdmissionRejected):
+        admission.get_documents_from_ids(["3", "4"], tenant="acme")
+    admission.get_documents_from_ids(["3", "4"], tenant="other")
+
+
+def test_admission_rejects_oversized_batches_before_any_work():
+    client = FakeClient({})
+    admission = AdmissionController(APP(client), tenant_limits={"acme": (1, 3)})
+    with pytest.raises(AdmissionRejected):
+        admission.get_documents_from_ids([str(i) for i in range(10)], tenant="acme")
+    with pytest.raises(AdmissionRejected):
+        admission.get_documents_from_ids([str(i) for i in range(10)], tenant="acme", timeout=1)
+    assert client.calls == []
+    assert admission.stats["interactive"]["rate_limited"] == 2
+
+
+def test_admission_paces_batches_larger_than_the_burst():
+    client = FakeClient({})
+    admission = AdmissionController(APP(client), tenant_limits={"acme": (100, 2)})
+    started = time.monotonic()
+    admission.get_documents_from_ids([str(i) for i in range(6)], tenant="acme", timeout=1)
+
+    assert time.monotonic() - started >= 0.03
+    assert sorted(client.calls) == [str(i) for i in range(6)]
+    assert admission.stats["interactive"]["admitted"] == 3
+
+
+def test_admission_serves_interactive_before_queued_batch_chunks():
+    client = SlowClient({}, delay=0.01)
+    admission = AdmissionController(APP(client), max_concurrency=1, batch_chunk_size=2)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        batch = pool.submit(admission.get_documents_from_ids, [f"b{i}" for i in range(10)], "batch")
+        time.sleep(0.015)
+        interactive = pool.submit(admission.get_documents_from_ids, ["i1"], "interactive")
+        interactive.result()
+        batch.result()
+
+    assert client.calls.index("i1") < 6
+
+
+def test_admission_rejects_when_queue_is_full():
+    admission = AdmissionController(APP(FakeClient({})), max_concurrency=1, queue_limits={"batch": 0})
+    admission.running = 1
+    with pytest.raises(AdmissionRejected):
+        admission.get_documents_from_ids(["1"], priority="batch")
+    assert admission.stats["batch"]["rejected"] == 1
+
+
+def test_partitioned_csv_routes_lookups_to_partitions(tmp_path):
+    for part in range(4):
+        rows = "".join(f"{part * 10 + i},c{part * 10 + i}\n" for i in range(10))
+        (tmp_path / f"part-{part}.csv").write_text("document_id,content\n" + rows)
+    app = APP.create_app_use_partitioned_csv(
+        use_cache=False,
+        partitioned_csv_config={"path": str(tmp_path), "processes": 2}
+    )
+    reader = app.client
+    try:
+        assert app.get_documents_from_ids(["5", "99"]) == {"5": {"5": "c5"}, "99": {}}
+        assert reader.state.locate("35").file_name.endswith("part-3.csv")
+        assert reader.get_documents(["1", "12", "25", "39"]) == {
+            "1": {"1": "c1"}, "12": {"12": "c12"}, "25": {"25": "c25"}, "39": {"39": "c39"}
+        }
+
+        (tmp_path / "part-4.csv").write_text("document_id,content\n99,c99\n12,duplicate\n")
+        (tmp_path / "part-0.csv").unlink()
+        assert reader.refresh() == [str(tmp_path / "part-4.csv"), str(tmp_path / "part-0.csv")]
+        assert reader.get_documents(["5", "99", "12"]) == {"5": {}, "99": {"99": "c99"}, "12": {"12": "c12"}}
+
+        # A part file deleted between the listing and the stat is skipped
+        listed = reader.list_files() + [str(tmp_path / "part-9.csv")]
+        with mock.patch.object(reader, "list_files", return_value=listed):
+            assert reader.refresh() == []
+    finally:
+        reader.close()
+
+
+@pytest.mark.parametrize(["compression"], [(None,), ("zlib",)])
+def test_cache_reloads_snapshot(tmp_path, compression):
+    path = str(tmp_path / "cache.snap")
+    config = {"file_name": "documents.csv"}
+    client = FakeClient({"1": {"1": "a" * 2000}, "2": {"2": "b"}})
+    cache = CacheReader(client, compression=compression, snapshot_path=path, source_config=config, ttl=60)
+    cache.get_document("1")
+    cache.get_document("2")
+    assert cache.save_snapshot(write_index=True) == 2
+
+    restarted = CacheReader(FakeClient({}), compression=compression, snapshot_path=path, source_config=config, ttl=60)
+    assert restarted.load_snapshot() == 2
+    assert restarted.get_document("1") == {"1": "a" * 2000}
+    assert restarted.client.calls == []
+    assert 0 < restarted.expires["2"] - time.monotonic() <= 60
+
+    index = SnapshotIndex(path, config_fingerprint(config))
+    assert restarted.decode(StoredValue(*index.get("2")[1:3])) == {"2": "b"}
+    assert index.get("3") is None
+    index.close()
+
+    # A snapshot saved without an index leaves the old index behind, which must not be used
+    client.documents["3"] = {"3": "c"}
+    cache.get_document("3")
+    cache.save_snapshot()
+    with pytest.raises(SnapshotMismatch):
+        SnapshotIndex(path, config_fingerprint(config))
+
+
+def test_cache_rejects_snapshot_for_other_source(tmp_path):
+    path = str(tmp_path / "cache.snap")
+    cache = CacheReader(FakeClient({"1": {"v": 1}}), snapshot_path=path, source_config={"file_name": "a.csv"})
+    cache.get_document("1")
+    cache.save_snapshot(write_index=True)
+
+    other = CacheReader(FakeClient({}), snapshot_path=path, source_config={"file_name": "b.csv"})
+    with pytest.raises(SnapshotMismatch):
+        other.load_snapshot()
+    assert len(other.cache) == 0
+    with pytest.raises(SnapshotMismatch):
+        SnapshotIndex(path, config_fingerprint({"file_name": "b.csv"}))
+
+
+def test_cache_snapshot_counts_downtime_against_ttl(tmp_path):
+    path = str(tmp_path / "cache.snap")
+    cache = CacheReader(FakeClient({"1": {"v": 1}, "2": {"v": 2}}), snapshot_path=path, ttl=60)
+    cache.get_document("1")
+    cache.get_document("2")
+    cache.expires["1"] = time.monotonic() + 5
+    cache.save_snapshot()
+
+    restarted = CacheReader(FakeClient({}), snapshot_path=path, ttl=60)
+    with mock.patch("time.time", return_value=time.time() + 30):
+        assert restarted.load_snapshot() == 1
+    assert list(restarted.cache) == ["2"]
+    assert 0 < restarted.expires["2"] - time.monotonic() <= 30
+
+    assert CacheReader(FakeClient({})).save_snapshot() == 0
+
+
+def test_profiler_traces_tiers_and_logs_slow_lookups(tmp_path, caplog):
+    csv_file = tmp_path / "documents.csv"
+    csv_file.write_text("document_id,content\n1,a\n")
+    mongo = MongoClient(CSVReader(str(csv_file)))
+    mongo.coll = mock.Mock()
+    mongo.coll.find_one.side_effect = lambda query, max_time_ms=None: {"2": "b"} if query["_id"] == "2" else None
+    app = APP(CacheReader(mongo), profiler=Profiler(sample_rate=1.0, slow_threshold=0))
+
+    with caplog.at_level("WARNING"):
+        app.get_documents_from_ids(["1", "2", "1"])
+
+    traces = list(app.profiler.traces)
+    assert [trace["answered_by"] for trace in traces] == ["csv", "mongo", "cache"]
+    assert [tier for tier, _, _ in traces[0]["spans"]] == ["mongo", "csv", "cache"]
+    assert app.profiler.tier_summary()["cache"]["found"] == 1
+    assert "Slow lookup of document 2" in caplog.text
+
+
+def test_profiler_capture_dumps_cpu_and_memory_profiles(tmp_path):
+    app = APP(FakeClient({"1": {"v": 1}}), profiler=Profiler(sample_rate=0))
+    timer = app.profiler.capture(duration=60, output_dir=str(tmp_path))
+    timer.cancel()
+    app.get_documents_from_ids(["1"])
+    paths = app.profiler.dump_capture(str(tmp_path))
+
+    assert pstats.Stats(paths["cpu"]).total_calls > 0
+    assert os.path.getsize(paths["memory"]) > 0
+    assert not app.profiler.capturing
+
+
+def test_profiler_runs_request_unprofiled_when_profiler_is_busy(tmp_path):
+    app = APP(FakeClient({"1": {"v": 1}}), profiler=Profiler(sample_rate=0))
+    app.profiler.capture(duration=60, output_dir=str(tmp_path)).cancel()
+    with mock.patch.object(cProfile.Profile, "enable", side_effect=ValueError("Another profiling tool is already active")):
+        assert app.get_documents_from_ids(["1"]) == {"1": {"v": 1}}
+    paths = app.profiler.dump_capture(str(tmp_path))
+
+    assert app.profiler.skipped_profiles == 1
+    assert "cpu" not in paths
+
+
+@pytest.mark.parametrize(["mode"], [("closed",), ("fixed",), ("open",)])
+def test_loadgen_replays_zipf_trace(tmp_path, mode):
+    csv_file = tmp_path / "documents.csv"
+    csv_file.write_text("document_id,content\n" + "".join(f"{i},c{i}\n" for i in range(1, 51)))
+    config = tmp_path / "app.json"
+    config.write_text(json.dumps({
+        "factory": "create_app_use_csvreader",
+        "kwargs": {"use_cache": True, "csv_reader_config": {"file_name": str(csv_file)}}
+    }))
+    output = tmp_path / "report.json"
+
+    assert main([
+        str(config), "--zipf", "50", "--requests", "200", "--seed", "1",
+        "--mode", mode, "--rate", "2000", "--report-interval", "0.05", "--output", str(output)
+    ]) == 0
+    report = json.loads(output.read_text())
+    assert report["requests"] == 200
+    assert report["errors"] == 0
+    assert report["cache"]["misses"] <= 50
+    assert report["cache"]["hit_rate"] > 0.7
+    assert report["timeline"][-1]["completed"] == 200
+    assert 0 < report["timeline"][-1]["cache_entries"] <= 50
+    assert "cache_bytes" not in report["timeline"][-1]
+    assert report["timeline"][-1]["rss_kb"] > 0
+
+
+def test_loadgen_reads_timestamped_trace(tmp_path):
+    trace = tmp_path / "trace.log"
+    trace.write_text("100.0,1\n100.5,2\n101.0,1\n")
+    assert load_trace(str(trace)) == (["1", "2", "1"], [0.0, 0.5, 1.0])
+
+
+def test_chain_router_learns_to_query_the_tier_holding_the_data():
+    mongo = SlowClient({}, delay=0.002)
+    csv_reader = FakeClient({f"c{i}": {"v": i} for i in range(100)})
+    router = ChainRouter([("mongo", mongo), ("csv", csv_reader)], min_samples=5, explore_rate=0)
+    assert [step["tier"] for step in router.plan("c1")] == ["mongo", "csv"]
+
+    for i in range(20):
+        assert router.get_document(f"c{i}") == {"v": i}
+
+    assert [step["tier"] for step in router.explain("c50")["plan"]] == ["csv", "mongo"]
+    assert len(mongo.calls) < 5
+    assert router.stats_snapshot()["*"]["csv"]["hits"] == 20
+
+
+def test_chain_router_orders_per_prefix_and_honours_pinned_order():
+    mongo = FakeClient({f"m{i}": {"v": i} for i in range(30)})
+    csv_reader = FakeClient({f"c{i}": {"v": i} for i in range(30)})
+    router = ChainRouter([("mongo", mongo), ("csv", csv_reader)], prefix_length=1, min_samples=5, explore_rate=0)
+    for i in range(10):
+        router.get_document(f"m{i}")
+        router.get_document(f"c{i}")
+
+    assert router.plan("m20")[0]["tier"] == "mongo"
+    assert router.plan("c20")[0]["tier"] == "csv"
+    pinned = ChainRouter([("mongo", mongo), ("csv", csv_reader)], pinned_order=["csv", "mongo"])
+    assert pinned.explain("m1") == {
+        "bucket": "*",
+        "pinned": True,
+        "plan": [
+            {"tier": "csv", "hit_probability": 0.5, "latency": 0.0, "attempts": 0, "score": 2e-06,
+             "skipped": False, "position": 0},
+            {"tier": "mongo", "hit_probability": 0.5, "latency": 0.0, "attempts": 0, "score": 2e-06,
+             "skipped": False, "position": 1}
+        ]
+    }
+
+
+def test_chain_router_skips_tiers_that_never_hit_when_not_exhaustive():
+    mongo = FakeClient({})
+    csv_reader = FakeClient({})
+    router = ChainRouter(
+        [("mongo", mongo), ("csv", csv_reader)], min_samples=5, skip_below=0.05, exhaustive=False, explore_rate=0
+    )
+    for _ in range(50):
+        router.record(ALL_IDS, "mongo", 0.001, False)
+        router.record(ALL_IDS, "csv", 0.001, True)
+
+    assert [(step["tier"], step["skipped"]) for step in router.plan("1")] == [("csv", False), ("mongo", True)]
+    assert router.get_document("1") == {}
+    assert (mongo.calls, csv_reader.calls) == ([], ["1"])
+    router.exhaustive = True
+    router.get_document("1")
+    assert mongo.calls == ["1"]
+
+
+def test_chain_router_falls_through_and_demotes_a_failing_tier():
+    mysql = FakeClient({})
+    mysql.get_document = mock.Mock(side_effect=ConnectionError("mysql is down"))
+    csv_reader = FakeClient({"1": {"v": 1}})
+    router = ChainRouter([("mysql", mysql), ("csv", csv_reader)], min_samples=1, explore_rate=0)
+    for _ in range(5):
+        router.record(ALL_IDS, "mysql", 0.0001, True)
+        router.record(ALL_IDS, "csv", 0.01, True)
+
+    assert router.get_document("1") == {"v": 1}
+    assert router.get_document("1") == {"v": 1}
+    assert mysql.get_document.call_count == 1
+    assert router.stats_snapshot()["*"]["mysql"]["attempts"] == 6
+    assert router.plan("1")[0]["tier"] == "csv"
+
+    broken = ChainRouter([("mysql", mysql)], explore_rate=0)
+    with pytest.raises(ConnectionError):
+        broken.get_document("1")